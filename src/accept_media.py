@@ -1,11 +1,13 @@
 import os
-import re
-import shutil
-
-import requests
 
+from barcode_cache import BarcodeLookup, barcode_cache
+from batch_move import BatchMove
 from env_settings import settings
-from pydantic_models import PhotoRenamingResponse
+from folder_snapshot import folder_snapshot, forget_folder_snapshot
+from jobs import check_cancelled
+from media_catalog import media_catalog
+from media_record import MediaRecord
+from tracing import span, traced
 
 
 class PhotoFileNamesError(Exception):
@@ -23,36 +25,22 @@ class PhotoFileNamesError(Exception):
 
 
 class CallPhotoRenaming:
-    url = settings.PHOTO_RENAMING_URL
-    user = settings.LOGIN_1C
-    password = settings.PASSWORD_1C
-
     def __init__(self, unique_series):
         self.unique_series = unique_series
-        self.data = {'series': self.unique_series}
-        data = {'series': list(unique_series)}
-        response = requests.post(self.url, json=data, auth=(self.user, self.password))
-        response.raise_for_status()
-        self.request_result = PhotoRenamingResponse(response=response.json()).response
+        self.barcode_lookup = barcode_cache.lookup(unique_series)
+        self.request_result = self.barcode_lookup.rows
 
 
-class MediaFile:
-    photo_pattern = r'^\d+_[123]\.jpeg$'
-    video_pattern = r'^\d+_v1\.mp4$'
+class MediaFile(MediaRecord):
+    __slots__ = ('series', 'article')
 
     def __init__(self, file_name, kind):
-        self.file_name = file_name
-        self.barcode = None
-        self.angle = None
+        self.set_file_name(file_name)
+        if self.kind != kind.upper():
+            self.kind = self.barcode = self.angle = None
         self.series = None
         self.article = None
 
-        pattern = self.photo_pattern if kind == 'PHOTO' else self.video_pattern
-
-        if re.match(pattern, file_name):
-            name, extension = file_name.split('.')
-            self.barcode, self.angle = name.split('_')
-
     def __str__(self):
         return f'{self.file_name}'
 
@@ -70,62 +58,13 @@ class MediaFile:
     def fill_1c_data(self, request_result):
         if not self.barcode:
             return
-        photo_renaming_row = next(
-            photo_renaming_row
-            for photo_renaming_row in request_result
-            if photo_renaming_row.barcode == self.barcode
-        )
+        photo_renaming_row = request_result.get(self.barcode)
+        if not photo_renaming_row:
+            return
         self.series = photo_renaming_row.name
         self.article = photo_renaming_row.article
 
 
-class SourceArticles:
-    media_sources_path = settings.MEDIA_SOURCES_PATH
-
-    def __init__(self, media_type: str):
-        self.media_type = media_type
-        if self.media_type not in ('PHOTO', 'VIDEO'):
-            raise ValueError('kind should be PHOTO or VIDEO')
-        self.source_path = os.path.join(self.media_sources_path, 'SOURCES', self.media_type)
-        self.files = []
-        self.request_result = None
-
-    def __call__(self):
-        self.fill_files_from_folder()
-        request_1c = CallPhotoRenaming(self.get_unique_series())
-        self.fill_1c_data(request_1c.request_result)
-
-    def fill_files_from_folder(self):
-        """Заполняет таблицу."""
-        for file_name in os.listdir(self.source_path):
-            self.files.append(MediaFile(file_name, self.media_type))
-
-    def get_unique_series(self):
-        """Возвращает множество уникальных штрихкодов кроме пустых."""
-        unique_series = {
-            photo.barcode
-            for photo in self.files
-            if photo.barcode
-        }
-        return list(unique_series)
-
-    def fill_1c_data(self, request_result):
-        """Заполняет штрихкод фотографии из ответа от 1С."""
-        for photo in self.files:
-            photo.fill_1c_data(request_result)
-
-    def get_articles(self):
-        return {media_file.article for media_file in self.files if media_file.article}
-
-    def get_already_existing_reprs(self, article_intersection):
-        article_intersection = list(article_intersection)
-        result = []
-        for media_file in self.files:
-            if media_file in article_intersection:
-                result.append(repr(media_file))
-        return result
-
-
 class MediaAccept:
     media_sources_path = settings.MEDIA_SOURCES_PATH
 
@@ -137,28 +76,34 @@ class MediaAccept:
         self.source_path = os.path.join(self.media_sources_path, 'PHOTO_TEAM', self.kind)
         self.destination_path = os.path.join(self.media_sources_path, 'ACCEPTED', self.kind)
         self.media_files = []
+        self.barcode_lookup = BarcodeLookup({})
+        self.batch_move = BatchMove(f'accept_{self.kind.lower()}s')
 
     def __call__(self):
         self.check_folders()
         self.fill_files_from_folder()
-        request_1c = CallPhotoRenaming(self.get_unique_series())
+        with span('CallPhotoRenaming'):
+            request_1c = CallPhotoRenaming(self.get_unique_series())
+        self.barcode_lookup += request_1c.barcode_lookup
         self.fill_1c_data(request_1c.request_result)
         self.validate_files()
         self.check_article_uniqueness()
         self.move_files()
 
+    @traced
     def check_folders(self):
         """Проверяет, что папки готовы к работе."""
         assert (
-            len(os.listdir(self.source_path)) != 0
+            len(folder_snapshot(self.source_path)) != 0
         ), 'The source folder is empty'
         assert (
-            len(os.listdir(self.destination_path)) == 0
+            len(folder_snapshot(self.destination_path)) == 0
         ), 'The destination folder is not empty'
 
+    @traced
     def fill_files_from_folder(self):
         """Заполняет таблицу."""
-        for file_name in os.listdir(self.source_path):
+        for file_name in folder_snapshot(self.source_path).names:
             self.media_files.append(MediaFile(file_name, self.media_type))
 
     def get_unique_series(self):
@@ -170,11 +115,13 @@ class MediaAccept:
         }
         return list(unique_series)
 
+    @traced
     def fill_1c_data(self, request_result):
         """Заполняет штрихкод фотографии из ответа от 1С."""
         for photo in self.media_files:
             photo.fill_1c_data(request_result)
 
+    @traced
     def validate_files(self):
         bad_file_names = []
         bad_barcodes = []
@@ -186,17 +133,29 @@ class MediaAccept:
         if bad_file_names or bad_barcodes:
             raise PhotoFileNamesError(bad_file_names, bad_barcodes)
 
+    @traced
     def check_article_uniqueness(self):
+        """
+        Проверяет, что артикулов новых файлов еще нет в SOURCES.
+
+        Артикулы ищутся по индексу каталога, поэтому проверка стоит
+        пропорционально числу новых файлов. Каталог пересканируется,
+        только если папка SOURCES менялась не через бота, иначе
+        перезапрашиваются только устаревшие данные 1С штрихкодов партии.
+        """
         articles = self.get_articles()
-        source_articles = SourceArticles(self.media_type)
-        source_articles()
-        source_articles_articles = source_articles.get_articles()
-        article_intersection = articles & source_articles_articles
+        if media_catalog.is_current(self.kind):
+            barcodes = {media_file.barcode for media_file in self.media_files if media_file.barcode}
+            self.barcode_lookup += media_catalog.refresh_barcodes(self.kind, barcodes)
+        else:
+            catalog_refresh = media_catalog.refresh(self.kind)
+            self.barcode_lookup += catalog_refresh.barcode_lookup
+        source_files = media_catalog.files_with_articles(self.kind, articles)
+        article_intersection = {article for _, article in source_files}
         file_names = '\n'.join(
             [repr(media_file) for media_file in self.media_files if media_file.article in article_intersection],
         )
-        source_files = source_articles.get_already_existing_reprs(article_intersection)
-        source_files = '\n'.join(source_files)
+        source_files = '\n'.join(f'[{file_name}, {article}]' for file_name, article in source_files)
         if article_intersection:
             raise ValueError(
                 f'Articles {article_intersection} are already in the source folder.\nFile names:\n{file_names}\nSources:\n{source_files}',
@@ -205,13 +164,22 @@ class MediaAccept:
     def get_articles(self):
         return {media_file.article for media_file in self.media_files if media_file.article}
 
+    @traced
     def move_files(self):
-        for media_file in self.media_files:
-            src = os.path.join(
-                self.source_path, media_file.file_name,
+        check_cancelled()
+        try:
+            self.batch_move.move(
+                (
+                    os.path.join(self.source_path, media_file.file_name),
+                    os.path.join(self.destination_path, media_file.file_name),
+                )
+                for media_file in self.media_files
             )
-            dst = os.path.join(self.destination_path, media_file.file_name)
-            shutil.move(src, dst)
+        finally:
+            forget_folder_snapshot(self.source_path, self.destination_path)
+
+    def report(self):
+        return f'{self.batch_move.report()}\n{self.barcode_lookup.report()}'
 
 
 if __name__ == '__main__':
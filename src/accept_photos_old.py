@@ -1,5 +1,4 @@
 import os
-import re
 import shutil
 
 import requests
@@ -7,6 +6,8 @@ from dotenv import load_dotenv
 from telegram import Update
 
 from env_settings import settings
+from media_record import MediaRecord
+from metrics import timed_request
 
 
 class PhotoManager:
@@ -39,10 +40,6 @@ class Photos:
     def __init__(self, manager):
         self.manager = manager
         self.photos = []
-        if self.manager.kind == 'PHOTO':
-            self.pattern = r'^\d+_[123]\.jpeg$'
-        elif self.manager.kind == 'VIDEO':
-            self.pattern = r'^\d+_v1\.mp4'
         self.request_result = None
 
     def check_folders(self):
@@ -62,7 +59,7 @@ class Photos:
     def create_table(self):
         """Заполняет таблицу."""
         for file_name in os.listdir(self.manager.src_path):
-            self.photos.append(Photo(file_name, self.pattern))
+            self.photos.append(Photo(file_name, self.manager.kind))
 
     def get_unique_series(self):
         """Возвращает множество уникальных штрихкодов кроме пустых."""
@@ -83,7 +80,7 @@ class Photos:
         user = os.getenv('1C_LOGIN')
         password = os.getenv('1C_PASSWORD')
         data = {'series': list(unique_series)}
-        response = requests.post(url, json=data, auth=(user, password))
+        response = timed_request('photo_renaming', requests.post, url, json=data, auth=(user, password))
         response.raise_for_status()
         self.request_result = response.json()
 
@@ -133,16 +130,14 @@ class Photos:
             shutil.move(src, dst)
 
 
-class Photo:
-    def __init__(self, file_name, pattern):
-        self.file_name = file_name
-        self.barcode = None
-        self.angle = None
-        self.series = None
+class Photo(MediaRecord):
+    __slots__ = ('series',)
 
-        if re.match(pattern, file_name):
-            name, extension = file_name.split('.')
-            self.barcode, self.angle = name.split('_')
+    def __init__(self, file_name, kind):
+        self.set_file_name(file_name)
+        if self.kind != kind:
+            self.kind = self.barcode = self.angle = None
+        self.series = None
 
 
 class PhotoFileNamesError(Exception):
@@ -0,0 +1,93 @@
+import threading
+import time
+
+from env_settings import settings
+from photo_renaming_client import photo_renaming_client
+from pydantic_models import PhotoRenamingRow
+from state_files import load_json, save_json, state_path
+
+
+class BarcodeLookup:
+    """Rows keyed by barcode and how many of them came from the cache."""
+
+    def __init__(self, rows, hits=0, misses=0):
+        self.rows = rows
+        self.hits = hits
+        self.misses = misses
+
+    def __add__(self, other):
+        return BarcodeLookup({**self.rows, **other.rows}, self.hits + other.hits, self.misses + other.misses)
+
+    @property
+    def hit_ratio(self):
+        total = self.hits + self.misses
+        return self.hits / total if total else 1.0
+
+    def report(self):
+        return f'Barcode cache: {self.hits}/{self.hits + self.misses} hits ({self.hit_ratio:.0%})'
+
+
+class BarcodeCache:
+    """
+    Дисковый кэш ответов 1С по штрихкодам.
+
+    В кэш попадают только существующие в 1С штрихкоды, поэтому
+    только что заведенный штрихкод будет найден при следующем запросе.
+    """
+
+    def __init__(self, path, ttl):
+        self.path = path
+        self.ttl = ttl
+        self.entries = None
+        self.lock = threading.Lock()
+
+    def lookup(self, barcodes):
+        """Возвращает строки 1С, запрашивая только отсутствующие и устаревшие штрихкоды."""
+        barcodes = set(barcodes)
+        now = time.time()
+        with self.lock:
+            entries = self.get_entries()
+            cached = {
+                barcode: entries[barcode]['row']
+                for barcode in barcodes
+                if barcode in entries and now - entries[barcode]['fetched_at'] < self.ttl
+            }
+        missing = barcodes - cached.keys()
+        fetched = photo_renaming_client.lookup(missing) if missing else {}
+        with self.lock:
+            for row in fetched.values():
+                if row.name:
+                    self.entries[row.barcode] = {'fetched_at': now, 'row': row.model_dump(by_alias=True)}
+            if fetched:
+                self.save()
+        rows = {barcode: PhotoRenamingRow.model_validate(row) for barcode, row in cached.items()}
+        rows.update(fetched)
+        return BarcodeLookup(rows, hits=len(cached), misses=len(missing))
+
+    def invalidate(self, barcodes=None):
+        """Удаляет штрихкоды из кэша, без аргументов очищает кэш целиком."""
+        with self.lock:
+            entries = self.get_entries()
+            if barcodes is None:
+                entries.clear()
+            else:
+                for barcode in barcodes:
+                    entries.pop(barcode, None)
+            self.save()
+
+    def get_entries(self):
+        if self.entries is None:
+            self.entries = load_json(self.path, {})
+        return self.entries
+
+    def save(self):
+        now = time.time()
+        self.entries = {
+            barcode: entry
+            for barcode, entry in self.entries.items()
+            if now - entry['fetched_at'] < self.ttl
+        }
+        save_json(self.path, self.entries)
+
+
+barcode_cache = BarcodeCache(state_path('barcode_cache.json'), settings.BARCODE_CACHE_TTL)
@@ -0,0 +1,163 @@
+import glob
+import os
+
+from bulk_copy import BulkCopy
+from content_hashes import content_index
+from env_settings import settings
+from file_links import copy, format_size, remove_if_exists
+from jobs import check_cancelled, report_progress
+from metrics import metrics
+from state_files import fsync_file, fsync_folder, load_json, save_json, state_path
+
+
+class BatchMoveError(Exception):
+    pass
+
+
+class BatchMove:
+    """
+    Переносит пачку файлов целиком или не переносит ничего.
+
+    Перед переносом пачка записывается в журнал. В пределах одного устройства
+    файлы переименовываются, между устройствами копируются параллельно во
+    временный файл, размер копии сверяется с исходником, и только после
+    копирования всей пачки исходники удаляются. При ошибке уже перенесенные
+    файлы возвращаются обратно. Журнал, оставшийся после падения процесса,
+    разбирается при следующем запуске: незавершенное копирование откатывается,
+    незавершенное удаление исходников доводится до конца.
+    """
+
+    def __init__(self, name, parallelism=None):
+        self.name = name
+        self.journal_path = state_path(f'move_journal_{name}.json')
+        self.parallelism = max(parallelism or settings.MOVE_PARALLELISM, 1)
+        self.renamed_number = 0
+        self.copied_number = 0
+        self.copied_bytes = 0
+
+    def move(self, pairs):
+        """Переносит файлы, pairs - список (исходник, назначение)."""
+        self.recover()
+        pairs = list(pairs)
+        if not pairs:
+            return
+        self.check(pairs)
+        moves = [[src, dst, self.method(src, dst)] for src, dst in pairs]
+        self.write_journal('moving', moves)
+        try:
+            self.rename_files([move for move in moves if move[2] == 'rename'])
+            self.copy_files([move for move in moves if move[2] == 'copy'])
+        except BaseException:
+            self.roll_back(moves)
+            self.remove_journal()
+            raise
+        self.sync_destinations(moves)
+        self.write_journal('removing_sources', moves)
+        self.remove_sources(moves)
+        self.remove_journal()
+
+    def check(self, pairs):
+        missing = [src for src, _ in pairs if not os.path.exists(src)]
+        existing = [dst for _, dst in pairs if os.path.exists(dst)]
+        if missing or existing:
+            message = 'The files were not moved'
+            if missing:
+                message += '\nMissing sources:\n' + '\n'.join(missing)
+            if existing:
+                message += '\nAlready existing destinations:\n' + '\n'.join(existing)
+            raise BatchMoveError(message)
+
+    @staticmethod
+    def method(src, dst):
+        same_device = os.stat(os.path.dirname(src) or '.').st_dev == os.stat(os.path.dirname(dst) or '.').st_dev
+        return 'rename' if same_device else 'copy'
+
+    def rename_files(self, moves):
+        for index, (src, dst, _) in enumerate(moves):
+            check_cancelled()
+            os.rename(src, dst)
+            self.renamed_number += 1
+            report_progress(f'{index + 1}/{len(moves)} files moved')
+
+    def copy_files(self, moves):
+        bulk_copy = BulkCopy(self.parallelism)
+        bulk_copy.run(self.copy_file, [(os.stat(src).st_size, src, dst, method) for src, dst, method in moves])
+        self.copied_number += bulk_copy.copied_number
+        self.copied_bytes += bulk_copy.copied_bytes
+
+    @staticmethod
+    def copy_file(src, dst, method):
+        """Копирует файл, сверяя размер и, если включено VERIFY_COPIES, контрольную сумму копии."""
+        temp_path = f'{dst}.part'
+        copy(src, temp_path)
+        size = os.stat(src).st_size
+        copied_size = os.stat(temp_path).st_size
+        if copied_size != size:
+            remove_if_exists(temp_path)
+            raise BatchMoveError(f'{dst} has {copied_size} bytes after copying, {src} has {size}')
+        if settings.VERIFY_COPIES:
+            try:
+                content_index.verify_copy(src, temp_path, method)
+            except Exception:
+                remove_if_exists(temp_path)
+                raise
+        fsync_file(temp_path)
+        os.replace(temp_path, dst)
+        metrics.bytes_copied.inc(size, operation='move')
+        return size
+
+    @staticmethod
+    def sync_destinations(moves):
+        """Сбрасывает на диск папки назначения, чтобы исходники удалялись только после сохранения копий."""
+        for folder in sorted({os.path.dirname(dst) or '.' for _, dst, _ in moves}):
+            fsync_folder(folder)
+
+    def remove_sources(self, moves):
+        for src, dst, method in moves:
+            if method == 'copy' and os.path.exists(dst):
+                remove_if_exists(src)
+
+    @staticmethod
+    def roll_back(moves):
+        """Возвращает файлы в исходное состояние: переименованные обратно, копии удаляются."""
+        for src, dst, method in moves:
+            remove_if_exists(f'{dst}.part')
+            if method == 'rename':
+                if os.path.exists(dst) and not os.path.exists(src):
+                    os.rename(dst, src)
+            elif os.path.exists(src):
+                remove_if_exists(dst)
+
+    def recover(self):
+        """Разбирает журнал, оставшийся после падения процесса."""
+        journal = load_json(self.journal_path, None)
+        if not journal:
+            return None
+        moves = journal['moves']
+        if journal['status'] == 'moving':
+            self.roll_back(moves)
+        else:
+            self.remove_sources(moves)
+        self.remove_journal()
+        return journal['status']
+
+    def write_journal(self, status, moves):
+        save_json(self.journal_path, {'status': status, 'moves': moves}, durable=True)
+
+    def remove_journal(self):
+        remove_if_exists(self.journal_path)
+
+    def report(self):
+        report = f'Moved {self.renamed_number + self.copied_number} files'
+        if self.copied_number:
+            report += f', {self.copied_number} copied across devices ({format_size(self.copied_bytes)})'
+        return report
+
+
+def recover_batch_moves():
+    """Разбирает журналы всех пачек, прерванных падением процесса."""
+    recovered = {}
+    for journal_path in glob.glob(state_path('move_journal_*.json')):
+        name = os.path.basename(journal_path)[len('move_journal_'):-len('.json')]
+        recovered[name] = BatchMove(name).recover()
+    return recovered
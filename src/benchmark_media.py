@@ -0,0 +1,403 @@
+"""
+Бенчмарк команд над папками медиа на синтетическом дереве MEDIA_SOURCES_PATH.
+
+Для каждого количества файлов генерирует дерево SOURCES/PHOTO_TEAM с маленькими
+JPEG и mp4, поднимает локальную заглушку 1С и замеряет этапы: время, число
+системных вызовов чтения и записи (/proc/self/io) и пик памяти Python (tracemalloc).
+Каждый этап выполняется с пустым STATE_PATH (cold) и повторно с заполненными кэшами (warm).
+
+    python benchmark_media.py --files 1000 10000 100000 --output benchmark.json
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from functools import partial
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import BytesIO
+from types import SimpleNamespace
+
+UNKNOWN_BARCODE_PREFIX = '9'
+
+
+class Fake1CHandler(BaseHTTPRequestHandler):
+    """Заглушка PHOTO_RENAMING_URL: штрихкоды, начинающиеся с UNKNOWN_BARCODE_PREFIX, в 1С не существуют."""
+
+    requests_number = 0
+    barcodes_number = 0
+    duplicate_every = 0
+    lock = threading.Lock()
+
+    def do_POST(self):  # noqa: N802
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        series = json.loads(body)['series']
+        with self.lock:
+            Fake1CHandler.requests_number += 1
+            Fake1CHandler.barcodes_number += len(series)
+        rows = [self.make_row(barcode) for barcode in series if not barcode.startswith(UNKNOWN_BARCODE_PREFIX)]
+        response = json.dumps(rows, ensure_ascii=False).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(response)))
+        self.end_headers()
+        self.wfile.write(response)
+
+    def make_row(self, barcode):
+        article_number = int(barcode)
+        if self.duplicate_every and article_number % self.duplicate_every == 1:
+            article_number -= 1
+        return {
+            'ШК': barcode,
+            'Наименование': barcode,
+            'Трим_Аим': f'AIM{barcode}',
+            'Металл': 'Au 585',
+            'Диагностика': '',
+            'Артикул': f'A{article_number}',
+        }
+
+    def log_message(self, format, *args):  # noqa: A002
+        pass
+
+
+def start_fake_1c(duplicate_every):
+    Fake1CHandler.duplicate_every = duplicate_every
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Fake1CHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def configure_environment(root, url):
+    """Задает переменные окружения до импорта модулей бота, так как они читают настройки при импорте."""
+    os.environ.update({
+        'MEDIA_SOURCES_PATH': os.path.join(root, 'media'),
+        'STATE_PATH': os.path.join(root, 'state'),
+        'PHOTO_RENAMING_URL': url,
+        'RENAME_LINK_MODE': os.environ.get('RENAME_LINK_MODE', 'copy'),
+    })
+    for name in ('TELEGRAM_TOKEN', 'STOCK_DATA_EQUIVALENCE', 'LOGIN_1C', 'PASSWORD_1C', 'CANCEL_ORDER_URL'):
+        os.environ.setdefault(name, 'benchmark')
+
+
+def make_jpeg(side):
+    from PIL import Image
+
+    buffer = BytesIO()
+    Image.new('RGB', (side, side), (200, 170, 90)).save(buffer, 'JPEG', quality=90)
+    return buffer.getvalue()
+
+
+class MediaTree:
+    """Синтетическое дерево MEDIA_SOURCES_PATH."""
+
+    folders = (
+        'SOURCES/PHOTO', 'SOURCES/VIDEO', 'PHOTO_TEAM/PHOTO', 'PHOTO_TEAM/VIDEO',
+        'ACCEPTED/PHOTO', 'ACCEPTED/VIDEO', 'RENAMED/PHOTO', 'RENAMED/VIDEO', 'RESIZED_PHOTOS',
+    )
+
+    def __init__(self, path, args):
+        self.path = path
+        self.args = args
+        self.random = random.Random(args.seed)
+        self.jpeg = make_jpeg(args.jpeg_side)
+        self.mp4 = bytes(args.mp4_bytes)
+        self.batch_number = 0
+        self.batch = []
+
+    def folder(self, name):
+        return os.path.join(self.path, name)
+
+    def write(self, folder, file_name, data):
+        with open(os.path.join(self.folder(folder), file_name), 'wb') as file:
+            file.write(data)
+
+    def angles(self):
+        return self.random.choices((1, 2, 3), weights=self.args.angle_weights)[0]
+
+    def file_names(self, files_number, first_barcode):
+        """Возвращает (имя, это видео) так, чтобы всего было files_number файлов."""
+        result = []
+        barcode = first_barcode
+        while len(result) < files_number:
+            if self.random.random() < self.args.bad_ratio:
+                result.append((f'IMG_{len(result)}.jpeg', False))
+                continue
+            result.extend(self.barcode_file_names(barcode))
+            barcode += 1
+        return result[:files_number]
+
+    def barcode_file_names(self, barcode):
+        """Возвращает (имя, это видео) ракурсов и видео одного штрихкода."""
+        barcode_text = str(barcode)
+        if self.random.random() < self.args.unknown_ratio:
+            barcode_text = UNKNOWN_BARCODE_PREFIX + barcode_text[1:]
+        result = [(f'{barcode_text}_{angle}.jpeg', False) for angle in range(1, self.angles() + 1)]
+        if self.random.random() < self.args.video_ratio:
+            result.append((f'{barcode_text}_v1.mp4', True))
+        return result
+
+    def generate(self, files_number):
+        shutil.rmtree(self.path, ignore_errors=True)
+        for folder in self.folders:
+            os.makedirs(self.folder(folder))
+        for file_name, is_video in self.file_names(files_number, 2_000_000_000):
+            if is_video:
+                self.write('SOURCES/VIDEO', file_name, self.mp4)
+            else:
+                self.write('SOURCES/PHOTO', file_name, self.jpeg)
+
+    def generate_batch(self, files_number):
+        """Кладет в PHOTO_TEAM новую партию со штрихкодами, которых нет в SOURCES, прежняя партия удаляется."""
+        self.remove_batch()
+        for folder in ('PHOTO_TEAM/PHOTO', 'PHOTO_TEAM/VIDEO', 'ACCEPTED/PHOTO', 'ACCEPTED/VIDEO'):
+            shutil.rmtree(self.folder(folder))
+            os.makedirs(self.folder(folder))
+        self.batch_number += 1
+        self.batch = self.file_names(files_number, 3_000_000_000 + self.batch_number * 10_000_000)
+        for file_name, is_video in self.batch:
+            if is_video:
+                self.write('PHOTO_TEAM/VIDEO', file_name, self.mp4)
+            else:
+                self.write('PHOTO_TEAM/PHOTO', file_name, self.jpeg)
+
+    def remove_batch(self):
+        """Удаляет из SOURCES партию, которую туда перенесла приемка."""
+        for file_name, is_video in self.batch:
+            folder = 'SOURCES/VIDEO' if is_video else 'SOURCES/PHOTO'
+            try:
+                os.remove(os.path.join(self.folder(folder), file_name))
+            except FileNotFoundError:
+                pass
+        self.batch = []
+
+
+def read_io_counters():
+    try:
+        with open('/proc/self/io') as file:
+            counters = dict(line.split(': ') for line in file.read().splitlines())
+    except OSError:
+        return None
+    return int(counters['syscr']), int(counters['syscw'])
+
+
+def reset_state(state_path):
+    """Очищает STATE_PATH и сбрасывает кэши модулей, загруженные в память."""
+    from barcode_cache import barcode_cache
+    from content_hashes import content_index
+    from media_catalog import media_catalog
+
+    shutil.rmtree(state_path, ignore_errors=True)
+    os.makedirs(state_path)
+    barcode_cache.entries = None
+    media_catalog.initialized = False
+    content_index.initialized = False
+
+
+def prepare_batch(tree):
+    tree.generate_batch(tree.args.batch)
+
+
+def parse_file_names(tree):
+    from media_record import parse_file_name
+
+    file_names = os.listdir(tree.folder('SOURCES/PHOTO')) + os.listdir(tree.folder('SOURCES/VIDEO'))
+    start = time.perf_counter()
+    records = [parse_file_name(file_name) for file_name in file_names]
+    seconds = time.perf_counter() - start
+    # Размер самой записи без общих строк имени и штрихкода; для сравнения - такой же словарь
+    record = records[0] if records else parse_file_name('1_1.jpeg')
+    as_dict = {name: getattr(record, name) for name in record.__slots__}
+    return {
+        'records_per_second': round(len(records) / seconds) if seconds else None,
+        'bytes_per_record': sys.getsizeof(record),
+        'bytes_per_dict': sys.getsizeof(as_dict),
+    }
+
+
+def accept_photos(tree):
+    from accept_media import MediaAccept
+
+    MediaAccept('PHOTO')()
+
+
+def accept_media(tree):
+    from media_accept import AcceptMedia
+
+    AcceptMedia()()
+
+
+def check_photos(tree):
+    from check_sources import Photos
+
+    Photos(SimpleNamespace(kind='PHOTO', src_path=tree.folder('SOURCES/PHOTO'))).validate_files()
+
+
+def find_photos_with_same_article(tree):
+    from find_photos_with_same_article import main
+
+    main()
+
+
+def find_duplicates(tree):
+    from find_duplicates import main
+
+    main()
+
+
+def rename_photos(tree):
+    from rename_photos import DocumentPhotoRename
+
+    document = DocumentPhotoRename(tree.folder('SOURCES/PHOTO'), tree.folder('RENAMED/PHOTO'), 'PHOTO')
+    document.start()
+    if document.result['exception']:
+        raise ValueError(document.result['wrong_file_names'] or document.result['wrong_barcodes'])
+
+
+def resize_photos(tree):
+    from resize_photos import DocumentResizePhotos
+
+    document = DocumentResizePhotos(tree.folder('SOURCES/PHOTO'), tree.folder('RESIZED_PHOTOS'))
+    document.prepare_sizes_list()
+    document.prepare_folders()
+    document.resize()
+
+
+# Этап -> (подготовка, выполнение); подготовка не входит в замер. Выполнение возвращает None
+# или словарь числовых метрик, который добавляется к результату. Модули бота импортируются
+# внутри этапов, так как читают настройки при импорте, а окружение задается в run
+STAGES = {
+    'parse_file_names': (None, parse_file_names),
+    'accept_photos': (prepare_batch, accept_photos),
+    'accept_media': (prepare_batch, accept_media),
+    'check_photos': (None, check_photos),
+    'find_photos_with_same_article': (None, find_photos_with_same_article),
+    'find_duplicates': (None, find_duplicates),
+    'rename_photos': (None, rename_photos),
+    'resize_photos': (None, resize_photos),
+}
+
+
+def measure(func, trace_memory):
+    if trace_memory:
+        tracemalloc.reset_peak()
+    io_before = read_io_counters()
+    requests_before = Fake1CHandler.requests_number, Fake1CHandler.barcodes_number
+    start = time.perf_counter()
+    error = None
+    metrics = None
+    try:
+        metrics = func()
+    except Exception as e:
+        error = f'{e.__class__.__name__}: {str(e)[:200]}'
+    seconds = time.perf_counter() - start
+    io_after = read_io_counters()
+    result = {
+        'seconds': round(seconds, 4),
+        'read_syscalls': io_after[0] - io_before[0] if io_before else None,
+        'write_syscalls': io_after[1] - io_before[1] if io_before else None,
+        'peak_memory_mb': round(tracemalloc.get_traced_memory()[1] / 1024 / 1024, 2) if trace_memory else None,
+        'requests_1c': Fake1CHandler.requests_number - requests_before[0],
+        'barcodes_1c': Fake1CHandler.barcodes_number - requests_before[1],
+        'error': error,
+    }
+    result.update(metrics or {})
+    return result
+
+
+def run(args):
+    root = args.workdir or tempfile.mkdtemp(prefix='benchmark_media_')
+    server = start_fake_1c(args.duplicate_every)
+    configure_environment(root, f'http://127.0.0.1:{server.server_address[1]}/photo_renaming')
+    tree = MediaTree(os.environ['MEDIA_SOURCES_PATH'], args)
+    if not args.no_memory:
+        tracemalloc.start()
+    results = []
+    for files_number in args.files:
+        tree.generate(files_number)
+        for stage in args.stages:
+            results.extend(run_stage(tree, stage, files_number, not args.no_memory))
+            tree.remove_batch()
+    server.shutdown()
+    if not args.workdir:
+        shutil.rmtree(root, ignore_errors=True)
+    return {
+        'created_at': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'args': {name: value for name, value in vars(args).items() if name != 'output'},
+        'results': results,
+    }
+
+
+def run_stage(tree, stage, files_number, trace_memory):
+    """Замеряет этап с пустым STATE_PATH (cold) и повторно с заполненными кэшами (warm)."""
+    prepare, func = STAGES[stage]
+    results = []
+    for run_name in ('cold', 'warm'):
+        if run_name == 'cold':
+            reset_state(os.environ['STATE_PATH'])
+        if prepare:
+            prepare(tree)
+        result = {'files': files_number, 'stage': stage, 'run': run_name}
+        result.update(measure(partial(func, tree), trace_memory))
+        results.append(result)
+        print(format_result(result), flush=True)
+    return results
+
+
+def format_result(result):
+    line = (
+        f'{result["files"]:>7} {result["stage"]:<30} {result["run"]:<4} {result["seconds"]:>9.3f} s '
+        f'r/w syscalls {result["read_syscalls"]}/{result["write_syscalls"]} '
+        f'peak {result["peak_memory_mb"]} MB, 1C {result["requests_1c"]} req/{result["barcodes_1c"]} barcodes'
+    )
+    if 'records_per_second' in result:
+        line += (
+            f', {result["records_per_second"]} records/s, '
+            f'{result["bytes_per_record"]} B/record ({result["bytes_per_dict"]} B as dict)'
+        )
+    if result['error']:
+        line += f' [{result["error"]}]'
+    return line
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--files', type=int, nargs='+', default=[1000, 10000, 100000], help='SOURCES sizes')
+    parser.add_argument('--stages', nargs='+', choices=STAGES, default=list(STAGES))
+    parser.add_argument('--batch', type=int, default=100, help='files put into PHOTO_TEAM for accept stages')
+    parser.add_argument(
+        '--angle-weights', type=float, nargs=3, default=[0.2, 0.3, 0.5], help='weights of 1, 2 and 3 angles',
+    )
+    parser.add_argument('--video-ratio', type=float, default=0.3, help='share of barcodes with a video')
+    parser.add_argument('--bad-ratio', type=float, default=0.0, help='share of files with a wrong name')
+    parser.add_argument('--unknown-ratio', type=float, default=0.0, help='share of barcodes missing in 1C')
+    parser.add_argument(
+        '--duplicate-every', type=int, default=50, help='every N-th barcode shares an article with the previous one',
+    )
+    parser.add_argument('--jpeg-side', type=int, default=64)
+    parser.add_argument('--mp4-bytes', type=int, default=1024)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--workdir', help='keep the generated tree and state here instead of a temporary folder')
+    parser.add_argument('--no-memory', action='store_true', help='do not trace memory, tracemalloc slows Python down')
+    parser.add_argument('--output', help='write results as JSON to this file')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    report = run(args)
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(report, file, ensure_ascii=False, indent=2)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,85 @@
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from env_settings import settings
+from file_links import format_size
+from jobs import check_cancelled, report_progress
+
+
+def format_duration(seconds):
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f'{hours}:{minutes:02}:{seconds:02}' if hours else f'{minutes}:{seconds:02}'
+
+
+class BulkCopy:
+    """
+    Выполняет копирования файлов в ограниченном пуле потоков.
+
+    Пока одни файлы пишутся, другие уже читаются, поэтому сетевая папка
+    не простаивает между файлами. Ход сообщается через report_progress:
+    файлы, объем, скорость и оставшееся время по средней скорости.
+    """
+
+    def __init__(self, workers=None, verb='copied'):
+        self.workers = max(workers or settings.COPY_WORKERS, 1)
+        self.verb = verb
+        self.copied_number = 0
+        self.copied_bytes = 0
+        self.duration = 0
+
+    def run(self, func, tasks):
+        """
+        Вызывает func(*args) для каждой задачи (размер, *args) и возвращает результаты в порядке задач.
+
+        При первой ошибке или отмене задачи, еще не начатые, отменяются, а ошибка пробрасывается.
+        """
+        tasks = list(tasks)
+        results = [None] * len(tasks)
+        if not tasks:
+            return results
+        total_bytes = sum(size for size, *_ in tasks)
+        done_number = done_bytes = 0
+        start = time.monotonic()
+        with ThreadPoolExecutor(max_workers=min(self.workers, len(tasks)), thread_name_prefix='copy') as executor:
+            futures = {executor.submit(func, *args): (index, size) for index, (size, *args) in enumerate(tasks)}
+            pending = set(futures)
+            try:
+                while pending:
+                    done, pending = wait(pending, timeout=settings.JOBS_PROGRESS_INTERVAL, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        index, size = futures[future]
+                        results[index] = future.result()
+                        done_number += 1
+                        done_bytes += size
+                    check_cancelled()
+                    report_progress(
+                        self.progress(done_number, len(tasks), done_bytes, total_bytes, time.monotonic() - start),
+                    )
+            except BaseException:
+                for future in pending:
+                    future.cancel()
+                raise
+            finally:
+                self.copied_number += done_number
+                self.copied_bytes += done_bytes
+                self.duration += time.monotonic() - start
+        return results
+
+    def progress(self, done_number, files_number, done_bytes, total_bytes, elapsed):
+        text = (
+            f'{done_number}/{files_number} files {self.verb}, '
+            f'{format_size(done_bytes)} of {format_size(total_bytes)}'
+        )
+        if elapsed > 0 and done_bytes:
+            rate = done_bytes / elapsed
+            eta = (total_bytes - done_bytes) / rate
+            text += f', {format_size(rate)}/s, ETA {format_duration(eta)}'
+        return text
+
+    def report(self):
+        rate = self.copied_bytes / self.duration if self.duration else 0
+        return (
+            f'{self.copied_number} files {self.verb}, {format_size(self.copied_bytes)} '
+            f'in {self.duration:.0f} sec., {format_size(rate)}/s'
+        )
@@ -1,6 +1,7 @@
 import requests
 
 from env_settings import settings
+from metrics import timed_request
 
 
 class CancelOrder:
@@ -16,6 +17,8 @@ class CancelOrder:
         params = {
             'order_id': self.order_id,
         }
-        response = requests.get(self.url, params=params, auth=(self.user, self.password))
+        response = timed_request(
+            'cancel_order', requests.get, self.url, params=params, auth=(self.user, self.password),
+        )
         response.raise_for_status()
         self.update.message.reply_text(response.text)
@@ -1,11 +1,11 @@
 import os
-import re
 
-import requests
-from dotenv import load_dotenv
 from telegram import Update
 
 from env_settings import settings
+from folder_snapshot import folder_snapshot
+from media_catalog import CatalogRefresh, media_catalog
+from tracing import trace_report, traced
 
 
 class CheckSourcesManager:
@@ -25,92 +25,34 @@ class CheckSourcesManager:
             document = Photos(self)
             document.check_folder()
             document.validate_files()
-            self.temp_message.reply_text('Checking completed.')
+            text = f'Checking completed.\n{document.catalog_refresh.report()}{trace_report()}'
         except PhotoFileNamesError as e:
-            self.temp_message.reply_text(f'Error: {e}')
+            text = f'Error: {e}'
+        self.temp_message.reply_text(text)
+        return text
 
 
 class Photos:
-    url = settings.PHOTO_RENAMING_URL
-    user = settings.LOGIN_1C
-    password = settings.PASSWORD_1C
-
     def __init__(self, manager):
         self.manager = manager
-        self.photos = []
-        if self.manager.kind == 'PHOTO':
-            self.pattern = r'^\d+_[123]\.jpeg$'
-        elif self.manager.kind == 'VIDEO':
-            self.pattern = r'^\d+_v1\.mp4'
-        self.request_result = None
+        self.catalog_refresh = CatalogRefresh()
 
     def check_folder(self):
         assert (
-            len(os.listdir(self.manager.src_path)) != 0
+            len(folder_snapshot(self.manager.src_path)) != 0
         ), 'The source folder is empty'
 
+    @traced
     def validate_files(self):
-        self.create_table()
-        self.make_request()
-        self.join_1c_data()
-        self.validate_table()
-
-    def create_table(self):
-        """Заполняет таблицу."""
-        for file_name in os.listdir(self.manager.src_path):
-            self.photos.append(Photo(file_name, self.pattern))
-
-    def make_request(self):
-        """Делает запрос к 1С."""
-        load_dotenv(override=True)
-        unique_series = self.get_unique_series()
-        if not unique_series:
-            return
-        data = {'series': list(unique_series)}
-        response = requests.post(self.url, json=data, auth=(self.user, self.password))
-        response.raise_for_status()
-        self.request_result = response.json()
-
-    def get_unique_series(self):
-        """Возвращает множество уникальных штрихкодов кроме пустых."""
-        unique_series = {
-            photo.barcode
-            for photo in self.photos
-            if photo.barcode
-        }
-        return unique_series
-
-    def join_1c_data(self):
-        """Заполняет штрихкод фотографии из ответа от 1С."""
-        for photo in self.photos:
-            if not photo.barcode:
-                continue
-            # Для каждой строки таблицы из папки ищем штрихкод в ответе от 1С
-            found_dict = next(
-                request_line
-                for request_line in self.request_result
-                if request_line.get('ШК') == photo.barcode
-            )
-            photo.series = found_dict['Наименование']
-
-    def validate_table(self):
         """
-        Проверяет таблицу.
+        Проверяет исходники по каталогу.
 
-        Проверяет таблицу на наличие невалидных имен файлов
-        и несуществующих штрихкодов
-        Если есть одно или второе, то файловых операций не будет выполнено
+        Каталог обновляется только для изменившихся файлов, после чего
+        невалидные имена и несуществующие штрихкоды выбираются запросами.
         """
-        invalid_pattern_file_names = [
-            photo.file_name
-            for photo in self.photos
-            if not photo.barcode
-        ]
-        non_existent_barcode_file_names = [
-            photo.file_name
-            for photo in self.photos
-            if photo.barcode and not photo.series
-        ]
+        self.catalog_refresh = media_catalog.refresh(self.manager.kind)
+        invalid_pattern_file_names = media_catalog.wrong_file_names(self.manager.kind)
+        non_existent_barcode_file_names = media_catalog.unknown_barcode_file_names(self.manager.kind)
         if invalid_pattern_file_names or non_existent_barcode_file_names:
             raise PhotoFileNamesError(
                 invalid_pattern_file_names,
@@ -118,18 +60,6 @@ class Photos:
             )
 
 
-class Photo:
-    def __init__(self, file_name, pattern):
-        self.file_name = file_name
-        self.barcode = None
-        self.angle = None
-        self.series = None
-
-        if re.match(pattern, file_name):
-            name, extension = file_name.split('.')
-            self.barcode, self.angle = name.split('_')
-
-
 class PhotoFileNamesError(Exception):
     def __init__(
         self, invalid_pattern_file_names, non_existent_barcode_file_names,
@@ -0,0 +1,245 @@
+import hashlib
+import itertools
+import os
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing
+
+from PIL import Image
+
+from env_settings import settings
+from folder_snapshot import folder_snapshot
+from jobs import check_cancelled, report_progress
+from state_files import StateDatabase, state_path
+
+JPEG_EXTENSIONS = ('.jpeg', '.jpg')
+
+
+class CopyVerificationError(Exception):
+    def __init__(self, src, dst):
+        super().__init__(f'The copy {dst} does not match its source {src}')
+
+
+def file_digest(path):
+    with open(path, 'rb') as file:
+        return hashlib.file_digest(file, lambda: hashlib.blake2b(digest_size=16)).hexdigest()
+
+
+def difference_hash(path):
+    """Возвращает 64-битный dHash изображения: как меняется яркость слева направо на картинке 9x8."""
+    with Image.open(path) as img:
+        img.draft('L', (64, 64))
+        pixels = list(img.convert('L').resize((9, 8), Image.LANCZOS).getdata())
+    value = 0
+    for row in range(8):
+        for column in range(8):
+            value = value << 1 | (pixels[row * 9 + column] > pixels[row * 9 + column + 1])
+    return value
+
+
+def hash_file(path):
+    """Возвращает хэш содержимого и, для JPEG, dHash в шестнадцатеричном виде."""
+    dhash = None
+    if path.lower().endswith(JPEG_EXTENSIONS):
+        try:
+            dhash = f'{difference_hash(path):016x}'
+        except OSError:
+            pass
+    return file_digest(path), dhash
+
+
+class IndexUpdate:
+    def __init__(self, hashed=0, cached=0, removed=0):
+        self.hashed = hashed
+        self.cached = cached
+        self.removed = removed
+
+    def report(self):
+        return f'Hashed {self.hashed}, cached {self.cached}, removed {self.removed}'
+
+
+class ContentIndex(StateDatabase):
+    """
+    Индекс хэшей содержимого файлов в SQLite.
+
+    Хэш считается один раз на файл: повторно используется хэш любой записи
+    с тем же (inode, размер, время изменения), поэтому переименованные
+    и перенесенные в пределах устройства файлы не перечитываются.
+    """
+
+    schema = (
+        'CREATE TABLE IF NOT EXISTS files ('
+        'folder TEXT NOT NULL, '
+        'file_name TEXT NOT NULL, '
+        'inode INTEGER NOT NULL, '
+        'size INTEGER NOT NULL, '
+        'modified_at INTEGER NOT NULL, '
+        'digest TEXT NOT NULL, '
+        'dhash TEXT, '
+        'PRIMARY KEY (folder, file_name));'
+        'CREATE INDEX IF NOT EXISTS files_stat ON files (inode, size, modified_at);'
+        'CREATE INDEX IF NOT EXISTS files_digest ON files (digest);'
+    )
+
+    def __init__(self, path, workers):
+        super().__init__(path)
+        self.workers = max(workers, 1)
+
+    def update(self, folder):
+        """Досчитывает хэши новых и изменившихся файлов папки параллельно, удаляет пропавшие."""
+        snapshot = folder_snapshot(folder)
+        with self.lock, closing(self.connect()) as connection:
+            known = {
+                (inode, size, modified_at): (digest, dhash)
+                for inode, size, modified_at, digest, dhash in connection.execute(
+                    'SELECT inode, size, modified_at, digest, dhash FROM files',
+                )
+            }
+            stale = {
+                file_name
+                for file_name, in connection.execute('SELECT file_name FROM files WHERE folder = ?', (folder,))
+            }
+        result = IndexUpdate()
+        rows = []
+        tasks = []
+        for file_name, key in file_keys(snapshot):
+            stale.discard(file_name)
+            if key in known:
+                result.cached += 1
+                rows.append((folder, file_name, *key, *known[key]))
+            else:
+                tasks.append((file_name, key))
+        rows.extend(self.hash_files(folder, tasks))
+        result.hashed = len(tasks)
+        result.removed = len(stale)
+        with self.lock, closing(self.connect()) as connection, connection:
+            connection.executemany('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?)', rows)
+            connection.executemany(
+                'DELETE FROM files WHERE folder = ? AND file_name = ?', [(folder, file_name) for file_name in stale],
+            )
+        return result
+
+    def hash_files(self, folder, tasks):
+        """
+        Считает хэши файлов (имя, ключ stat) в пуле и возвращает строки индекса.
+
+        При отмене задачи еще не начатые хэши отменяются, поэтому команда
+        не ждет хэширования всей папки.
+        """
+        rows = []
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            futures = [executor.submit(hash_file, os.path.join(folder, file_name)) for file_name, _ in tasks]
+            try:
+                for (file_name, key), future in zip(tasks, futures):
+                    rows.append((folder, file_name, *key, *future.result()))
+                    check_cancelled()
+                    report_progress(f'{len(rows)}/{len(tasks)} files hashed')
+            except BaseException:
+                for future in futures:
+                    future.cancel()
+                raise
+        return rows
+
+    def digest(self, path):
+        """Возвращает хэш содержимого файла, если файл не менялся с прошлого подсчета - из индекса."""
+        stat = os.stat(path)
+        with self.lock, closing(self.connect()) as connection:
+            row = connection.execute(
+                'SELECT digest FROM files WHERE inode = ? AND size = ? AND modified_at = ? LIMIT 1',
+                (stat.st_ino, stat.st_size, stat.st_mtime_ns),
+            ).fetchone()
+        return row[0] if row else file_digest(path)
+
+    def verify_copy(self, src, dst, strategy='copy'):
+        """Сверяет копию с исходником; жесткая ссылка и reflink делят данные с исходником и не сверяются."""
+        if strategy != 'copy':
+            return
+        if self.digest(src) != file_digest(dst):
+            raise CopyVerificationError(src, dst)
+
+    def exact_duplicates(self, folders):
+        """Возвращает группы путей к файлам с одинаковым содержимым."""
+        folders = list(folders)
+        placeholders = ', '.join('?' * len(folders))
+        with self.lock, closing(self.connect()) as connection:
+            rows = connection.execute(
+                f'SELECT digest, folder, file_name FROM files WHERE folder IN ({placeholders}) AND digest IN ('
+                f'SELECT digest FROM files WHERE folder IN ({placeholders}) GROUP BY digest HAVING COUNT(*) > 1) '
+                'ORDER BY digest, folder, file_name',
+                (*folders, *folders),
+            ).fetchall()
+        groups = {}
+        for digest, folder, file_name in rows:
+            groups.setdefault(digest, []).append(os.path.join(folder, file_name))
+        return list(groups.values())
+
+    def near_duplicates(self, folders, max_distance):
+        """
+        Возвращает группы путей к JPEG с похожим dHash, не совпадающих побайтно.
+
+        64 бита хэша делятся на max_distance + 1 полос: у хэшей на расстоянии
+        Хэмминга не больше max_distance хотя бы одна полоса совпадает, поэтому
+        сравниваются только хэши из общих корзин, а не все пары.
+        """
+        folders = list(folders)
+        placeholders = ', '.join('?' * len(folders))
+        with self.lock, closing(self.connect()) as connection:
+            rows = connection.execute(
+                f'SELECT folder, file_name, digest, dhash FROM files WHERE folder IN ({placeholders}) '
+                'AND dhash IS NOT NULL ORDER BY folder, file_name',
+                folders,
+            ).fetchall()
+        files_by_hash = {}
+        for folder, file_name, digest, dhash in rows:
+            files_by_hash.setdefault(int(dhash, 16), []).append((os.path.join(folder, file_name), digest))
+        hashes = list(files_by_hash)
+        groups = {}
+        for index, root in enumerate(similar_hash_roots(hashes, max_distance)):
+            groups.setdefault(root, []).extend(files_by_hash[hashes[index]])
+        return [
+            sorted(path for path, _ in group)
+            for group in groups.values()
+            if len({digest for _, digest in group}) > 1
+        ]
+
+
+def file_keys(snapshot):
+    """Возвращает (имя, (inode, размер, время изменения)) файлов снимка папки."""
+    for entry in snapshot:
+        if entry.name != '.DS_Store' and entry.is_file():
+            stat = entry.stat()
+            yield entry.name, (entry.inode(), stat.st_size, stat.st_mtime_ns)
+
+
+def hash_buckets(hashes, bands):
+    """Раскладывает номера хэшей по корзинам (полоса, значение полосы)."""
+    band_bits = -(-64 // bands)
+    buckets = {}
+    for index, value in enumerate(hashes):
+        for band in range(bands):
+            buckets.setdefault((band, value >> (band * band_bits) & ((1 << band_bits) - 1)), []).append(index)
+    return buckets
+
+
+def similar_hash_roots(hashes, max_distance):
+    """
+    Объединяет хэши на расстоянии Хэмминга не больше max_distance в группы.
+
+    Возвращает для каждого хэша номер представителя его группы.
+    """
+    parents = list(range(len(hashes)))
+    for members in hash_buckets(hashes, max_distance + 1).values():
+        for first, second in itertools.combinations(members, 2):
+            first_root, second_root = find_root(parents, first), find_root(parents, second)
+            if first_root != second_root and (hashes[first] ^ hashes[second]).bit_count() <= max_distance:
+                parents[second_root] = first_root
+    return [find_root(parents, index) for index in range(len(hashes))]
+
+
+def find_root(parents, index):
+    while parents[index] != index:
+        parents[index] = parents[parents[index]]
+        index = parents[index]
+    return index
+
+
+content_index = ContentIndex(state_path('content_hashes.sqlite3'), settings.HASH_WORKERS)
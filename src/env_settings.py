@@ -1,3 +1,5 @@
+from typing import Literal
+
 from pydantic_settings import BaseSettings
 from pydantic import Field
 from dotenv import load_dotenv
@@ -8,11 +10,57 @@ load_dotenv()
 class Settings(BaseSettings):
     TELEGRAM_TOKEN: str
     STOCK_DATA_EQUIVALENCE: str = Field(description='Path to the folder with stock data equivalence')
+    STOCK_EQUIVALENCE_CACHE_TTL: int = Field(default=300, description='Seconds a stock equivalence answer is reused')
+    STOCK_EQUIVALENCE_PAGE_SIZE: int = Field(default=20, description='Discrepancy rows shown per page')
+    STOCK_EQUIVALENCE_ATTACHMENT_FORMAT: Literal['csv', 'json'] = Field(
+        default='csv', description='Format of the gzip-compressed full stock equivalence result',
+    )
+    STOCK_SNAPSHOTS_KEEP: int = Field(default=200, description='Stock equivalence snapshots kept for /stock_diff')
+    STOCK_SNAPSHOTS_MAX_AGE_DAYS: int = Field(default=90, description='Snapshots older than this are deleted')
+    STOCK_DIFF_KEY_FIELDS: list[str] = Field(
+        default=[], description='Row fields identifying a discrepancy, JSON list; default is section and first field',
+    )
     LOGIN_1C: str
     PASSWORD_1C: str
     MEDIA_SOURCES_PATH: str
     PHOTO_RENAMING_URL: str = Field(description='Send barcodes, validates they exist and get articles')
+    PHOTO_RENAMING_CHUNK_SIZE: int = Field(default=500, description='Barcodes sent to 1C in one request')
+    PHOTO_RENAMING_PARALLELISM: int = Field(default=4, description='Concurrent requests to PHOTO_RENAMING_URL')
+    PHOTO_RENAMING_TIMEOUT: int = Field(default=300, description='Seconds to wait for one PHOTO_RENAMING_URL request')
+    RENAME_INCREMENTAL: bool = Field(default=True, description='Copy only changed files into RENAMED')
+    RENAME_LINK_MODE: Literal['copy', 'hardlink', 'reflink', 'auto'] = Field(
+        default='auto', description='How RENAMED files are created: auto tries reflink, hardlink, then copy',
+    )
+    RESIZE_WORKERS: int = Field(default=0, description='Resize worker processes, 0 means one per CPU')
+    RESIZE_CHUNK_SIZE: int = Field(default=8, description='Photos handed to a resize worker at once')
+    RESIZE_MAX_INFLIGHT_MB: int = Field(default=256, description='Source megabytes queued to resize workers at once')
+    RESIZE_MAX_IMAGE_MB: int = Field(default=128, description='Memory limit for one decoded photo while resizing')
+    RESIZE_QUALITY_CHECK: bool = Field(
+        default=False, description='Compare resized photos with a full LANCZOS resize and their size with JPEG q90',
+    )
+    HASH_WORKERS: int = Field(default=4, description='Threads hashing file contents for the duplicate index')
+    NEAR_DUPLICATE_DISTANCE: int = Field(default=4, description='Max differing dHash bits for near-duplicate photos')
+    VERIFY_COPIES: bool = Field(default=True, description='Compare checksums of copied files with their sources')
+    COPY_WORKERS: int = Field(default=4, description='Parallel copies when RENAMED files are created')
+    MOVE_PARALLELISM: int = Field(default=4, description='Parallel copies when accepted files move across devices')
+    JOBS_MAX_WORKERS: int = Field(default=4, description='Long commands executed at the same time')
+    JOBS_DEFAULT_COMMAND_LIMIT: int = Field(default=1, description='Running jobs allowed per command')
+    JOBS_COMMAND_LIMITS: dict[str, int] = Field(default={}, description='Per-command overrides, JSON object')
+    JOBS_PROGRESS_INTERVAL: float = Field(default=5, description='Minimum seconds between progress edits')
     CANCEL_ORDER_URL: str = Field(description='Cancel order by order_id')
+    STATE_PATH: str = Field(default='state', description='Folder for local bot state: caches, manifests, databases')
+    BARCODE_CACHE_TTL: int = Field(default=24 * 60 * 60, description='Seconds a cached 1C barcode lookup stays fresh')
+    MEDIA_WATCHER: Literal['off', 'auto', 'inotify', 'poll'] = Field(
+        default='off', description='Pre-validate PHOTO_TEAM files as they arrive, auto prefers inotify',
+    )
+    MEDIA_WATCHER_POLL_INTERVAL: float = Field(default=5, description='Seconds between PHOTO_TEAM rescans')
+    METRICS_PORT: int = Field(default=0, description='Port of the Prometheus metrics endpoint, 0 disables it')
+    METRICS_HOST: str = Field(default='127.0.0.1', description='Interface the metrics endpoint listens on')
+    ADMIN_USER_IDS: list[int] = Field(default=[], description='Telegram users allowed to run admin commands, JSON list')
+    PROFILING_ENABLED: bool = Field(default=False, description='Register /profile for admins')
+    PROFILE_TOP: int = Field(default=40, description='Functions and allocations listed in a /profile report')
+    TRACE_LOG_MAX_MB: int = Field(default=10, description='Size of STATE_PATH/traces.jsonl before it is rotated')
+    WATCHER_CHAT_ID: int = Field(default=0, description='Chat for early file name warnings, 0 means no warnings')
 
 settings = Settings()
 print("Env vars successfully initialized")
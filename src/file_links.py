@@ -0,0 +1,165 @@
+import errno
+import fcntl
+import os
+import shutil
+
+FICLONE = 0x40049409
+LINK_MODES = {
+    'copy': ('copy',),
+    'hardlink': ('hardlink', 'copy'),
+    'reflink': ('reflink', 'copy'),
+    'auto': ('reflink', 'hardlink', 'copy'),
+}
+UNSUPPORTED_ERRNOS = {
+    errno.EOPNOTSUPP, errno.ENOTTY, errno.EXDEV, errno.EINVAL, errno.EPERM, errno.ENOSYS, errno.EMLINK,
+}
+COPY_CHUNK_SIZE = 64 * 1024 * 1024
+
+# (устройство исходника, устройство назначения) -> стратегии, которые там не работают
+unsupported_strategies = {}
+# (устройство исходника, устройство назначения) -> системные вызовы копирования, которые там не работают
+unsupported_copy_calls = {}
+
+
+def reflink(src, dst):
+    with open(src, 'rb') as src_file, open(dst, 'wb') as dst_file:
+        fcntl.ioctl(dst_file.fileno(), FICLONE, src_file.fileno())
+    shutil.copystat(src, dst)
+
+
+def hardlink(src, dst):
+    os.link(src, dst)
+
+
+def copy(src, dst):
+    copy_file_data(src, dst)
+    shutil.copystat(src, dst)
+
+
+def copy_file_data(src, dst):
+    """
+    Копирует содержимое файла в ядре: copy_file_range, затем sendfile, иначе обычным чтением.
+
+    copy_file_range на одной файловой системе может не переносить данные вовсе
+    (NFS 4.2, XFS, Btrfs), sendfile избавляет от копирования через память Python.
+    Возвращает число скопированных байт.
+    """
+    with open(src, 'rb') as src_file, open(dst, 'wb') as dst_file:
+        copied = kernel_copy(src_file.fileno(), dst_file.fileno())
+        if copied is not None:
+            return copied
+        shutil.copyfileobj(src_file, dst_file, COPY_CHUNK_SIZE)
+        return dst_file.tell()
+
+
+def kernel_copy(src_fd, dst_fd):
+    """
+    Копирует первым системным вызовом, который работает для пары устройств.
+
+    Неработающие вызовы запоминаются. Вызов, не скопировавший ни байта, уступает следующему,
+    как в shutil: некоторые файловые системы сразу отвечают 0 вместо ошибки. Пустые по stat
+    файлы (в том числе файлы procfs) копируются обычным чтением.
+    Возвращает число скопированных байт, None - если не подошел ни один.
+    """
+    if not os.fstat(src_fd).st_size:
+        return None
+    devices = (os.fstat(src_fd).st_dev, os.fstat(dst_fd).st_dev)
+    unsupported = unsupported_copy_calls.setdefault(devices, set())
+    for name, copy_call in (('copy_file_range', copy_file_range), ('sendfile', sendfile)):
+        if name in unsupported or not hasattr(os, name):
+            continue
+        copied = try_copy_call(copy_call, src_fd, dst_fd)
+        if copied is not None:
+            return copied
+        unsupported.add(name)
+    return None
+
+
+def try_copy_call(copy_call, src_fd, dst_fd):
+    """Пробует системный вызов копирования; если он не поддерживается или ничего не скопировал, возвращает None."""
+    try:
+        return copy_call(src_fd, dst_fd)
+    except OSError as error:
+        # Вызов не поддерживается, только если он упал до первого скопированного байта
+        if error.errno not in UNSUPPORTED_ERRNOS or os.lseek(dst_fd, 0, os.SEEK_CUR):
+            raise
+        return None
+
+
+def copy_file_range(src_fd, dst_fd):
+    copied = 0
+    while True:
+        sent = os.copy_file_range(src_fd, dst_fd, COPY_CHUNK_SIZE)
+        if not sent:
+            return copied or None
+        copied += sent
+
+
+def sendfile(src_fd, dst_fd):
+    copied = 0
+    while True:
+        sent = os.sendfile(dst_fd, src_fd, copied, COPY_CHUNK_SIZE)
+        if not sent:
+            return copied or None
+        copied += sent
+
+
+strategies = {
+    'reflink': reflink,
+    'hardlink': hardlink,
+    'copy': copy,
+}
+
+
+def place_file(src, dst, mode='copy'):
+    """
+    Размещает копию src по пути dst и возвращает использованную стратегию.
+
+    Файл сначала создается под временным именем и затем атомарно заменяет dst,
+    поэтому перезапись dst, который является жесткой ссылкой, не портит исходник.
+    Стратегии, не поддерживаемые парой файловых систем, запоминаются и больше не пробуются.
+    Временный файл, оставшийся от прерванного запуска, удаляется.
+    """
+    devices = (os.stat(src).st_dev, os.stat(os.path.dirname(dst) or '.').st_dev)
+    unsupported = unsupported_strategies.setdefault(devices, set())
+    temp_path = f'{dst}.part'
+    remove_if_exists(temp_path)
+    for strategy in LINK_MODES[mode]:
+        if strategy not in unsupported and try_strategy(strategy, src, temp_path, unsupported):
+            move_into_place(temp_path, dst, strategy)
+            return strategy
+    raise ValueError(f'Unknown link mode {mode!r}')
+
+
+def try_strategy(strategy, src, temp_path, unsupported):
+    """Пробует стратегию; если файловые системы ее не поддерживают, запоминает это и возвращает False."""
+    try:
+        strategies[strategy](src, temp_path)
+    except BaseException as error:
+        remove_if_exists(temp_path)
+        if strategy == 'copy' or not isinstance(error, OSError) or error.errno not in UNSUPPORTED_ERRNOS:
+            raise
+        unsupported.add(strategy)
+        return False
+    return True
+
+
+def move_into_place(temp_path, dst, strategy):
+    os.replace(temp_path, dst)
+    if strategy == 'hardlink':
+        # Если dst уже был ссылкой на тот же файл, rename ничего не делает и временное имя остается
+        remove_if_exists(temp_path)
+
+
+def remove_if_exists(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def format_size(size):
+    for unit in ('B', 'KB', 'MB', 'GB'):
+        if size < 1024 or unit == 'GB':
+            return f'{size:.0f} {unit}' if unit == 'B' else f'{size:.1f} {unit}'
+        size /= 1024
@@ -0,0 +1,38 @@
+import os
+
+import yaml
+
+from content_hashes import IndexUpdate, content_index
+from env_settings import settings
+from tracing import span
+
+
+def main():
+    """Ищет в SOURCES побайтные дубли и похожие фото, возвращает YAML-отчет и подпись к нему."""
+    sources_path = os.path.join(settings.MEDIA_SOURCES_PATH, 'SOURCES')
+    folders = [os.path.join(sources_path, kind) for kind in ('PHOTO', 'VIDEO')]
+    index_update = IndexUpdate()
+    for folder in folders:
+        with span('update_index'):
+            folder_update = content_index.update(folder)
+        index_update.hashed += folder_update.hashed
+        index_update.cached += folder_update.cached
+        index_update.removed += folder_update.removed
+    with span('exact_duplicates'):
+        exact_duplicates = content_index.exact_duplicates(folders)
+    with span('near_duplicates'):
+        near_duplicates = content_index.near_duplicates(folders, settings.NEAR_DUPLICATE_DISTANCE)
+    duplicates = {
+        'exact_duplicates': [[os.path.relpath(path, sources_path) for path in group] for group in exact_duplicates],
+        'near_duplicates': [[os.path.relpath(path, sources_path) for path in group] for group in near_duplicates],
+    }
+    yaml_str = yaml.dump(duplicates, default_flow_style=False, allow_unicode=True)
+    caption = (
+        f'Exact duplicate groups: {len(exact_duplicates)}, near-duplicate groups: {len(near_duplicates)}\n'
+        f'{index_update.report()}'
+    )
+    return {'bytes': yaml_str.encode('utf-8'), 'caption': caption}
+
+
+if __name__ == '__main__':
+    print(main()['caption'])
@@ -1,87 +1,19 @@
-import os.path
-import re
 from io import BytesIO
 
 import yaml
-import requests
 from dotenv import load_dotenv
 
-from env_settings import settings
+from media_catalog import media_catalog
+from tracing import span
 
 
 class PhotoError(Exception):
     pass
 
 
-def create_table(path):
-    table = []
-    photo_pattern = r'^\d+_[123]\.jpeg$'
-    video_pattern = r'^\d+_v1\.mp4$'
-    for file_name in os.listdir(path):
-        barcode = None
-        kind = None
-
-        if re.match(photo_pattern, file_name):
-            kind = 'photo'
-            name, extension = file_name.split('.')
-            barcode, angle = name.split('_')
-        elif re.match(video_pattern, file_name):
-            kind = 'video'
-            barcode = file_name.split('_v1.mp4')[0]
-
-        temp_dict = {
-            'src_file_name': file_name,
-            'src_kind': kind,
-            'src_barcode': barcode,
-            'src_correct_file_name': bool(barcode),
-            'oc_aim': None,
-            'oc_article': None,
-            'oc_barcode_exists': False,
-            'oc_reason': None,
-        }
-        table.append(temp_dict)
-    return table
-
-
-def make_request(table):
-    unique_series = {
-        file['src_barcode'] for file in table if file['src_barcode']
-    }
-    url = settings.MEDIA_SOURCES_PATH
-    user = settings.LOGIN_1C
-    password = settings.PASSWORD_1C
-    data = {'series': list(unique_series)}
-    response = requests.post(url, json=data, auth=(user, password))
-    response.raise_for_status()
-    return response.json()
-
-
-def join_1c_data(table, response_from_1c):
-    for table_row in table:
-        barcode = table_row['src_barcode']
-        if not barcode:
-            continue
-        response_row = next(
-            response_row
-            for response_row in response_from_1c
-            if response_row.get('ШК') == barcode
-        )
-        table_row['oc_aim'] = response_row['Трим_Аим']
-        table_row['oc_article'] = response_row['Артикул']
-        table_row['oc_barcode_exists'] = bool(response_row['Наименование'])
-        table_row['oc_reason'] = response_row['Диагностика']
-
-
-def check_table(table, result):
-    wrong_names = []
-    wrong_barcodes = []
-    for row in table:
-        if row['src_file_name'] == '.DS_Store':
-            continue
-        if not row['src_correct_file_name']:
-            wrong_names.append(row['src_file_name'])
-        elif not row['oc_barcode_exists']:
-            wrong_barcodes.append(row['src_file_name'])
+def check_catalog(result):
+    wrong_names = media_catalog.wrong_file_names('PHOTO')
+    wrong_barcodes = media_catalog.unknown_barcode_file_names('PHOTO')
 
     if wrong_names or wrong_barcodes:
         wrong_names_string = '\n'.join(wrong_names)
@@ -93,48 +25,22 @@ def check_table(table, result):
         raise PhotoError('There are photo naming issues')
 
 
-def get_files_table_from_path(path, result):
-    table = create_table(path)
-    response_from_1c = make_request(table)
-    join_1c_data(table, response_from_1c)
-    check_table(table, result)
-    return table
-
-
-def prepare_result(files_table, result):
-    article_to_barcode = {}
-    for row in files_table:
-        article = row['oc_article']
-        if article not in article_to_barcode:
-            article_to_barcode[article] = set()
-        article_to_barcode[article].add(row['src_barcode'])
-    articles_with_duplicates = []
-    for article, barcodes in article_to_barcode.items():
-        if len(barcodes) > 1:
-            articles_with_duplicates.append(article)
-    result = {}
-    for row in files_table:
-        if row['oc_article'] in articles_with_duplicates:
-            result.setdefault(row['oc_article'], []).append(
-                row['src_file_name'],
-            )
-    for _, file_names in result.items():
-        file_names.sort()
-    return result
-
-
 def main():
     load_dotenv()
 
     result = {
         'wrong_names': None,
         'wrong_barcodes': None,
+        'barcode_cache': None,
     }
 
-    photo_sources_path = os.getenv('MEDIA_SOURCES_PATH')
-    photo_folder_path = os.path.join(photo_sources_path, r'SOURCES/PHOTO')
-    files_table = get_files_table_from_path(photo_folder_path, result)
-    duplicating_photos = prepare_result(files_table, result)
+    with span('refresh_catalog'):
+        catalog_refresh = media_catalog.refresh('PHOTO')
+    result['barcode_cache'] = catalog_refresh.report()
+    with span('check_catalog'):
+        check_catalog(result)
+    with span('articles_with_multiple_barcodes'):
+        duplicating_photos = media_catalog.articles_with_multiple_barcodes('PHOTO')
 
     yaml_str = yaml.dump(
         duplicating_photos, default_flow_style=False, allow_unicode=True,
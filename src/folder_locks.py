@@ -0,0 +1,97 @@
+import threading
+from contextlib import ExitStack, contextmanager
+
+# Команда -> (папки для чтения, папки для записи) относительно MEDIA_SOURCES_PATH
+COMMAND_FOLDERS = {
+    'rename_photos': (('SOURCES/PHOTO',), ('RENAMED/PHOTO',)),
+    'rename_videos': (('SOURCES/VIDEO',), ('RENAMED/VIDEO',)),
+    'resize_photos': (('SOURCES/PHOTO',), ('RESIZED_PHOTOS',)),
+    'accept_photos': (('SOURCES/PHOTO',), ('PHOTO_TEAM/PHOTO', 'ACCEPTED/PHOTO')),
+    'accept_videos': (('SOURCES/VIDEO',), ('PHOTO_TEAM/VIDEO', 'ACCEPTED/VIDEO')),
+    'accept_media': ((), ('PHOTO_TEAM/PHOTO', 'PHOTO_TEAM/VIDEO', 'SOURCES/PHOTO', 'SOURCES/VIDEO')),
+    'check_photos': (('SOURCES/PHOTO',), ()),
+    'check_videos': (('SOURCES/VIDEO',), ()),
+    'find_photos_with_same_article': (('SOURCES/PHOTO',), ()),
+    'find_duplicates': (('SOURCES/PHOTO', 'SOURCES/VIDEO'), ()),
+}
+
+
+class ReadWriteLock:
+    """Блокировка с общим доступом на чтение и монопольным на запись, писатели в приоритете."""
+
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.readers = 0
+        self.writer = False
+        self.waiting_writers = 0
+
+    def acquire_read(self, timeout=None):
+        with self.condition:
+            if not self.condition.wait_for(lambda: not self.writer and not self.waiting_writers, timeout):
+                return False
+            self.readers += 1
+            return True
+
+    def release_read(self):
+        with self.condition:
+            self.readers -= 1
+            if not self.readers:
+                self.condition.notify_all()
+
+    def acquire_write(self, timeout=None):
+        with self.condition:
+            self.waiting_writers += 1
+            acquired = self.condition.wait_for(lambda: not self.writer and not self.readers, timeout)
+            self.waiting_writers -= 1
+            if acquired:
+                self.writer = True
+            else:
+                self.condition.notify_all()
+            return acquired
+
+    def release_write(self):
+        with self.condition:
+            self.writer = False
+            self.condition.notify_all()
+
+
+class FolderLocks:
+    def __init__(self):
+        self.locks = {}
+        self.lock = threading.Lock()
+
+    def get_lock(self, folder):
+        with self.lock:
+            return self.locks.setdefault(folder, ReadWriteLock())
+
+    def acquire(self, folder, write, on_wait=None):
+        """Захватывает папку и возвращает функцию освобождения, пока папка занята - вызывает on_wait."""
+        lock = self.get_lock(folder)
+        if write:
+            acquire, release = lock.acquire_write, lock.release_write
+        else:
+            acquire, release = lock.acquire_read, lock.release_read
+        while not acquire(timeout=None if on_wait is None else 1):
+            on_wait(folder)
+        return release
+
+    @contextmanager
+    def hold(self, reads=(), writes=(), on_wait=None):
+        """
+        Захватывает папки на время выполнения команды.
+
+        Папки захватываются в алфавитном порядке, поэтому команды
+        не могут заблокировать друг друга навсегда. Пока папка занята,
+        раз в секунду вызывается on_wait с ее именем.
+        """
+        with ExitStack() as stack:
+            for folder in sorted(set(reads) | set(writes)):
+                stack.callback(self.acquire(folder, folder in writes, on_wait))
+            yield
+
+    def hold_command(self, command, on_wait=None):
+        reads, writes = COMMAND_FOLDERS.get(command, ((), ()))
+        return self.hold(reads, writes, on_wait)
+
+
+folder_locks = FolderLocks()
@@ -0,0 +1,63 @@
+import os
+
+from jobs import current_job
+from metrics import count_files_scanned
+
+
+class FolderSnapshot:
+    """
+    Содержимое папки, прочитанное одним проходом os.scandir.
+
+    Данные stat берутся из DirEntry и кэшируются в нем, поэтому повторные
+    обращения к размеру и времени файла не делают системных вызовов.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.entries = {}
+        self.modified_at = None
+        self.refresh()
+
+    def refresh(self):
+        # Время изменения папки берется до чтения: изменения во время чтения сделают его устаревшим
+        self.modified_at = os.stat(self.path).st_mtime_ns
+        with os.scandir(self.path) as entries:
+            self.entries = {entry.name: entry for entry in entries}
+        count_files_scanned(self.path, len(self.entries))
+
+    def __contains__(self, name):
+        return name in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __iter__(self):
+        return iter(self.entries.values())
+
+    @property
+    def names(self):
+        return self.entries.keys()
+
+
+def folder_snapshot(path):
+    """
+    Возвращает снимок папки, общий для всей выполняемой команды.
+
+    Внутри задачи снимок папки читается один раз; после изменения папки
+    его нужно сбросить через forget_folder_snapshot. Вне задачи папка читается заново.
+    """
+    job = current_job()
+    if job is None:
+        return FolderSnapshot(path)
+    snapshot = job.folder_snapshots.get(path)
+    if snapshot is None:
+        snapshot = job.folder_snapshots[path] = FolderSnapshot(path)
+    return snapshot
+
+
+def forget_folder_snapshot(*paths):
+    job = current_job()
+    if job is None:
+        return
+    for path in paths:
+        job.folder_snapshots.pop(path, None)
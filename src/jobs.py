@@ -0,0 +1,234 @@
+import itertools
+import threading
+import time
+from collections import OrderedDict, defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+from telegram.error import TelegramError
+
+from env_settings import settings
+from folder_locks import folder_locks
+from metrics import metrics
+from profiling import profiled
+from tracing import trace
+
+local = threading.local()
+
+
+class JobCancelledError(Exception):
+    def __init__(self):
+        super().__init__('The job was cancelled')
+
+
+class Job:
+    def __init__(self, job_id, command, message, func):
+        self.id = job_id
+        self.command = command
+        self.message = message
+        self.func = func
+        self.status = 'queued'
+        self.created_at = time.monotonic()
+        self.started_at = None
+        self.finished_at = None
+        self.progress = ''
+        self.base_text = f'{message.text} (job {job_id})'
+        self.last_progress_at = 0
+        self.cancel_event = threading.Event()
+        self.waiters = []
+        self.result = None
+        self.folder_snapshots = {}
+
+    def __str__(self):
+        started_at = self.started_at or self.created_at
+        duration = (self.finished_at or time.monotonic()) - started_at
+        line = f'#{self.id} {self.command} {self.status} {duration:.0f} sec.'
+        if self.progress and self.status == 'running':
+            line += f' {self.progress}'
+        return line
+
+    def check_cancelled(self):
+        if self.cancel_event.is_set():
+            raise JobCancelledError()
+
+    def report_progress(self, text, force=False):
+        """Редактирует стартовое сообщение не чаще JOBS_PROGRESS_INTERVAL секунд."""
+        self.progress = text
+        now = time.monotonic()
+        if not force and now - self.last_progress_at < settings.JOBS_PROGRESS_INTERVAL:
+            return
+        self.last_progress_at = now
+        edit_message(self.message, f'{self.base_text}\n{text}')
+
+
+class JobManager:
+    """
+    Выполняет долгие команды бота в ограниченном пуле потоков.
+
+    Для каждой команды действует свой лимит одновременно выполняемых задач,
+    задачи сверх лимита ждут в очереди, не занимая потоки пула.
+    Повторный запрос команды с coalesce, которая уже ждет или выполняется,
+    присоединяется к ней и получает ее результат. Перед запуском задача
+    захватывает папки команды, чтобы конфликтующие команды выполнялись по очереди.
+    """
+
+    def __init__(self, max_workers, command_limits, default_command_limit, history_size=50):
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='job')
+        self.command_limits = command_limits
+        self.default_command_limit = default_command_limit
+        self.history_size = history_size
+        self.ids = itertools.count(1)
+        self.jobs = OrderedDict()
+        self.running = defaultdict(int)
+        self.pending = defaultdict(deque)
+        self.lock = threading.Lock()
+
+    def submit(self, command, message, func, coalesce=False):
+        """
+        Ставит func в очередь и возвращает задачу, message - стартовое сообщение команды.
+
+        С coalesce запрос присоединяется к уже ждущей или выполняющейся задаче команды,
+        иначе повторные запросы выполняются отдельно в пределах лимита команды.
+        func может вернуть текст результата, он будет отправлен присоединившимся запросам.
+        """
+        with self.lock:
+            active_job = self.find_active(command) if coalesce else None
+            if active_job:
+                active_job.waiters.append(message)
+            else:
+                job = Job(next(self.ids), command, message, profiled(func))
+                queued = self.enqueue(job)
+        if active_job:
+            edit_message(message, f'{message.text}\nJoined job {active_job.id}, waiting for its result')
+            return active_job
+        if queued:
+            edit_message(message, f'{job.base_text}\nqueued')
+        return job
+
+    def enqueue(self, job):
+        """Запускает задачу или ставит ее в очередь команды, если лимит занят; вызывается под self.lock."""
+        self.jobs[job.id] = job
+        self.trim_history()
+        if self.running[job.command] >= self.command_limits.get(job.command, self.default_command_limit):
+            self.pending[job.command].append(job)
+            return True
+        self.running[job.command] += 1
+        self.executor.submit(self.run, job)
+        return False
+
+    def run(self, job):
+        if job.cancel_event.is_set():
+            self.mark_cancelled(job)
+        else:
+            self.execute(job)
+        self.finish(job)
+        self.start_next(job.command)
+
+    def execute(self, job):
+        job.status = 'running'
+        job.started_at = time.monotonic()
+        local.job = job
+        try:
+            with folder_locks.hold_command(job.command, on_wait=partial(self.report_waiting, job)):
+                job.report_progress('running', force=True)
+                with trace(job.command, job=job.id):
+                    job.result = job.func()
+            job.status = 'done'
+        except JobCancelledError:
+            self.mark_cancelled(job)
+        except Exception as e:
+            job.status = 'failed'
+            job.message.reply_text(f'Error: {e}')
+        finally:
+            local.job = None
+            metrics.job_duration.observe(time.monotonic() - job.started_at, command=job.command, status=job.status)
+
+    def mark_cancelled(self, job):
+        job.status = 'cancelled'
+        job.message.reply_text(f'Job {job.id} cancelled.')
+
+    def report_waiting(self, job, folder):
+        job.check_cancelled()
+        job.report_progress(f'waiting for {folder}')
+
+    def find_active(self, command):
+        for job in self.jobs.values():
+            if job.command == command and job.status in ('queued', 'running') and not job.cancel_event.is_set():
+                return job
+        return None
+
+    def finish(self, job):
+        """Отправляет результат задачи присоединившимся запросам."""
+        job.finished_at = time.monotonic()
+        with self.lock:
+            waiters = list(job.waiters)
+        for message in waiters:
+            edit_message(message, f'{message.text}\nResult of job {job.id} ({job.status}):\n{job.result or ""}'[:4096])
+
+    def start_next(self, command):
+        """Освобождает место команды, отдавая его следующей задаче из очереди."""
+        with self.lock:
+            pending = self.pending[command]
+            if pending:
+                self.executor.submit(self.run, pending.popleft())
+            else:
+                self.running[command] -= 1
+
+    def cancel(self, job_id):
+        """Отменяет задачу: из очереди сразу, выполняющуюся - при следующей проверке."""
+        job = self.jobs.get(job_id)
+        if not job or job.status not in ('queued', 'running'):
+            return False
+        job.cancel_event.set()
+        with self.lock:
+            pending = self.pending[job.command]
+            dequeued = job in pending
+            if dequeued:
+                pending.remove(job)
+        if dequeued:
+            self.mark_cancelled(job)
+            self.finish(job)
+        return True
+
+    def trim_history(self):
+        finished_ids = [
+            job_id for job_id, job in self.jobs.items()
+            if job.status in ('done', 'failed', 'cancelled')
+        ]
+        for job_id in finished_ids[:max(len(self.jobs) - self.history_size, 0)]:
+            del self.jobs[job_id]
+
+    def report(self):
+        if not self.jobs:
+            return 'No jobs'
+        return '\n'.join(str(job) for job in reversed(self.jobs.values()))
+
+
+def edit_message(message, text):
+    try:
+        message.edit_text(text)
+    except TelegramError:
+        pass
+
+
+def current_job():
+    return getattr(local, 'job', None)
+
+
+def report_progress(text):
+    """Сообщает о ходе текущей задачи, вне задачи ничего не делает."""
+    job = current_job()
+    if job:
+        job.report_progress(text)
+
+
+def check_cancelled():
+    """Прерывает текущую задачу, если ее отменили."""
+    job = current_job()
+    if job:
+        job.check_cancelled()
+
+
+job_manager = JobManager(
+    settings.JOBS_MAX_WORKERS, settings.JOBS_COMMAND_LIMITS, settings.JOBS_DEFAULT_COMMAND_LIMIT,
+)
@@ -1,4 +1,5 @@
 import os
+from functools import partial
 
 from dotenv import load_dotenv
 from telegram import (
@@ -14,13 +15,23 @@ from telegram.ext import (
 )
 
 from find_photos_with_same_article import main as find_photos_with_same_article
+from find_duplicates import main as find_duplicates
 from rename_photos import RenamePhotos
 from resize_photos import ResizePhotos
 from accept_media import MediaAccept
 from check_sources import CheckSourcesManager
 from cancel_order import CancelOrder
-from stock_equivalence import StockEquivalence
+from stock_equivalence import StockEquivalence, stock_equivalence_pages
 from media_accept import AcceptMedia
+from media_watcher import media_watcher
+from media_catalog import media_catalog
+from barcode_cache import barcode_cache
+from batch_move import recover_batch_moves
+from jobs import JobCancelledError, job_manager
+from metrics import metrics
+from profiling import ProfileRequest, profile_submissions
+from tracing import trace_report
+from env_settings import settings
 
 
 def start(update: Update, context: CallbackContext) -> None:
@@ -28,6 +39,7 @@ def start(update: Update, context: CallbackContext) -> None:
     keyboard = InlineKeyboardMarkup(
         [
             [InlineKeyboardButton(text='Показать сверку', callback_data='1')],
+            [InlineKeyboardButton(text='Показать сверку без кэша', callback_data='4')],
             [
                 InlineKeyboardButton(
                     text='Загрузить отчет и показать сверку', callback_data='2',
@@ -44,68 +56,121 @@ def handle_callback(update: Update, context: CallbackContext):
     data = update.callback_query.data
     update.callback_query.answer()
     if data == '1':
-        StockEquivalence(update, update_1c_required=False).start()
+        submit_stock_equivalence(update, 'stock_data_equivalence', update_1c_required=False)
     elif data == '2':
-        StockEquivalence(update, update_1c_required=True).start()
+        submit_stock_equivalence(update, 'stock_data_equivalence_update', update_1c_required=True)
     elif data == '3':
         update.callback_query.message.delete()
+    elif data == '4':
+        submit_stock_equivalence(
+            update, 'stock_data_equivalence_refresh', update_1c_required=False, force_refresh=True,
+        )
+
+
+def handle_stock_equivalence_page(update: Update, context: CallbackContext):
+    _, token, page = update.callback_query.data.split(':')
+    text, keyboard = stock_equivalence_pages.render(token, int(page))
+    if text is None:
+        update.callback_query.answer('Результат устарел, запросите сверку заново')
+        return
+    update.callback_query.answer()
+    update.callback_query.message.edit_text(text, reply_markup=keyboard)
+
+
+def submit_stock_equivalence(update: Update, command, update_1c_required, force_refresh=False, diff_mode=False):
+    stock_equivalence = StockEquivalence(
+        update, update_1c_required=update_1c_required, force_refresh=force_refresh, diff_mode=diff_mode,
+    )
+    job_manager.submit(command, stock_equivalence.status_message, stock_equivalence.start)
 
 
 def stock_data_equivalence(update: Update, context: CallbackContext):
-    StockEquivalence(update, update_1c_required=False).start()
+    submit_stock_equivalence(update, 'stock_data_equivalence', update_1c_required=False)
 
 
 def stock_data_equivalence_update(update: Update, context: CallbackContext):
-    StockEquivalence(update, update_1c_required=True).start()
+    submit_stock_equivalence(update, 'stock_data_equivalence_update', update_1c_required=True)
+
+
+def stock_diff(update: Update, context: CallbackContext):
+    submit_stock_equivalence(update, 'stock_diff', update_1c_required=False, diff_mode=True)
 
 
 def rename_photos(update: Update, context: CallbackContext):
-    RenamePhotos(update, 'PHOTO').start()
+    rename = RenamePhotos(update, 'PHOTO')
+    job_manager.submit('rename_photos', rename.temp_message, rename.start, coalesce=True)
 
 
 def rename_videos(update: Update, context: CallbackContext):
-    RenamePhotos(update, 'VIDEO').start()
+    rename = RenamePhotos(update, 'VIDEO')
+    job_manager.submit('rename_videos', rename.temp_message, rename.start, coalesce=True)
 
 
-def accept_photos(update: Update, context: CallbackContext):
-    temp_message = update.message.reply_text('Accepting started...')
+def run_media_accept(temp_message, kind):
     try:
-        media_accept = MediaAccept('PHOTO')
+        media_accept = MediaAccept(kind)
         media_accept()
-        temp_message.reply_text('Accepting completed.')
+        text = f'Accepting completed.\n{media_accept.report()}{trace_report()}'
+    except JobCancelledError:
+        raise
     except Exception as e:
-        temp_message.reply_text(f'Error: {e}')
+        text = f'Error: {e}'
+    temp_message.reply_text(text)
+    return text
+
+
+def accept_photos(update: Update, context: CallbackContext):
+    temp_message = update.message.reply_text('Accepting started...')
+    job_manager.submit('accept_photos', temp_message, partial(run_media_accept, temp_message, 'PHOTO'), coalesce=True)
 
 
 def accept_videos(update: Update, context: CallbackContext):
     temp_message = update.message.reply_text('Accepting started...')
-    try:
-        media_accept = MediaAccept('VIDEO')
-        media_accept()
-        temp_message.reply_text('Accepting completed.')
-    except Exception as e:
-        temp_message.reply_text(f'Error: {e}')
+    job_manager.submit('accept_videos', temp_message, partial(run_media_accept, temp_message, 'VIDEO'), coalesce=True)
 
 
 def resize_photos(update: Update, context: CallbackContext):
-    ResizePhotos(update).start()
+    resize = ResizePhotos(update)
+    job_manager.submit('resize_photos', resize.temp_message, resize.start, coalesce=True)
+
+
+def run_find_photos_with_same_article(temp_message):
+    result = find_photos_with_same_article()
+    caption = f'{result["barcode_cache"]}{trace_report()}'
+    temp_message.reply_document(result['bytes'], 'find_photos_with_same_article.txt', caption=caption[:1024])
+    return f'find_photos_with_same_article.txt sent.\n{caption}'
 
 
 def handler_find_photos_with_same_article(
     update: Update, context: CallbackContext,
 ):
-    result = find_photos_with_same_article()
-    update.message.reply_document(
-        result['bytes'], 'find_photos_with_same_article.txt',
+    temp_message = update.message.reply_text('Searching started...')
+    job_manager.submit(
+        'find_photos_with_same_article', temp_message, partial(run_find_photos_with_same_article, temp_message),
+        coalesce=True,
     )
 
 
+def run_find_duplicates(temp_message):
+    result = find_duplicates()
+    caption = f'{result["caption"]}{trace_report()}'
+    temp_message.reply_document(result['bytes'], 'find_duplicates.txt', caption=caption[:1024])
+    return f'find_duplicates.txt sent.\n{caption}'
+
+
+def handler_find_duplicates(update: Update, context: CallbackContext):
+    temp_message = update.message.reply_text('Searching started...')
+    job_manager.submit('find_duplicates', temp_message, partial(run_find_duplicates, temp_message), coalesce=True)
+
+
 def check_photos(update: Update, context: CallbackContext):
-    CheckSourcesManager(update, 'PHOTO').start()
+    check = CheckSourcesManager(update, 'PHOTO')
+    job_manager.submit('check_photos', check.temp_message, check.start, coalesce=True)
 
 
 def check_videos(update: Update, context: CallbackContext):
-    CheckSourcesManager(update, 'VIDEO').start()
+    check = CheckSourcesManager(update, 'VIDEO')
+    job_manager.submit('check_videos', check.temp_message, check.start, coalesce=True)
 
 
 def cancel_order(update: Update, context: CallbackContext):
@@ -120,26 +185,113 @@ def cancel_order(update: Update, context: CallbackContext):
     order_id = context.args[0]
     CancelOrder(update, order_id).start()
 
-def accept_media(update: Update, context: CallbackContext):
-    temp_message = update.message.reply_text('Accepting started...')
+def run_accept_media(temp_message):
     try:
-        AcceptMedia()()
-        temp_message.reply_text('Accepting completed.')
+        accept = AcceptMedia(media_watcher)
+        accept()
+        text = f'Accepting completed.\n{accept.report()}{trace_report()}'
+    except JobCancelledError:
+        raise
     except Exception as e:
-        temp_message.reply_text(f'❌❌❌\n{e}')
+        text = f'❌❌❌\n{e}'
+    temp_message.reply_text(text)
+    return text
+
+
+def accept_media(update: Update, context: CallbackContext):
+    temp_message = update.message.reply_text('Accepting started...')
+    job_manager.submit('accept_media', temp_message, partial(run_accept_media, temp_message), coalesce=True)
+
+
+def jobs(update: Update, context: CallbackContext):
+    update.message.reply_text(job_manager.report())
+
+
+def cancel_job(update: Update, context: CallbackContext):
+    if update.message.from_user.id not in settings.ADMIN_USER_IDS:
+        return
+    if not context.args or not context.args[0].isdigit():
+        update.message.reply_text('Укажите номер задачи')
+        return
+    job_id = int(context.args[0])
+    if job_manager.cancel(job_id):
+        update.message.reply_text(f'Job {job_id} will be cancelled.')
+    else:
+        update.message.reply_text(f'Job {job_id} is not running.')
+
+
+def reset_barcode_cache(update: Update, context: CallbackContext):
+    """Сбрасывает кэш 1С для указанных штрихкодов, без параметров - целиком."""
+    if update.message.from_user.id not in settings.ADMIN_USER_IDS:
+        return
+    barcodes = list(context.args) or None
+    barcode_cache.invalidate(barcodes)
+    media_catalog.forget_1c_data(barcodes)
+    if barcodes:
+        update.message.reply_text(f'Barcode cache reset for {len(barcodes)} barcodes.')
+    else:
+        update.message.reply_text('Barcode cache reset.')
+
+
+def stats(update: Update, context: CallbackContext):
+    update.message.reply_text(metrics.report()[:4096])
+
+
+PROFILED_COMMANDS = {
+    'stock_data_equivalence': stock_data_equivalence,
+    'stock_data_equivalence_update': stock_data_equivalence_update,
+    'stock_diff': stock_diff,
+    'rename_photos': rename_photos,
+    'rename_videos': rename_videos,
+    'accept_photos': accept_photos,
+    'accept_videos': accept_videos,
+    'accept_media': accept_media,
+    'resize_photos': resize_photos,
+    'find_photos_with_same_article': handler_find_photos_with_same_article,
+    'find_duplicates': handler_find_duplicates,
+    'check_photos': check_photos,
+    'check_videos': check_videos,
+}
+
+
+def profile(update: Update, context: CallbackContext):
+    """Запускает команду под cProfile и присылает профиль, /profile [--memory] <command> [args]."""
+    if update.message.from_user.id not in settings.ADMIN_USER_IDS:
+        return
+    args = list(context.args)
+    trace_memory = bool(args) and args[0] == '--memory'
+    if trace_memory:
+        args = args[1:]
+    if not args or args[0] not in PROFILED_COMMANDS:
+        update.message.reply_text(
+            'Usage: /profile [--memory] <command> [args]\nCommands: ' + ', '.join(PROFILED_COMMANDS),
+        )
+        return
+    command = args[0]
+    context.args = args[1:]
+    request = ProfileRequest(update.message, command, trace_memory, settings.PROFILE_TOP)
+    with profile_submissions(request):
+        PROFILED_COMMANDS[command](update, context)
+    if not request.submitted:
+        update.message.reply_text(f'{command} joined a running job, it will not be profiled.')
 
 
 def main():
     load_dotenv(override=True)
 
     telegram_token = os.getenv('TELEGRAM_TOKEN')
-    updater = Updater(telegram_token)
+    updater = Updater(
+        telegram_token, request_kwargs={'con_pool_size': settings.JOBS_MAX_WORKERS + 8},
+    )
     dispatcher = updater.dispatcher
 
     dispatcher.add_handler(CommandHandler('bot', start))
     dispatcher.add_handler(
         CallbackQueryHandler(handle_callback, pattern='^\d$'),  # noqa W605
     )
+    dispatcher.add_handler(
+        CallbackQueryHandler(handle_stock_equivalence_page, pattern=r'^se:\d+:\d+$'),
+    )
 
     # data equivalence
     dispatcher.add_handler(
@@ -150,6 +302,7 @@ def main():
             'stock_data_equivalence_update', stock_data_equivalence_update,
         ),
     )
+    dispatcher.add_handler(CommandHandler('stock_diff', stock_diff))
 
     dispatcher.add_handler(CommandHandler('rename_photos', rename_photos))
     dispatcher.add_handler(
@@ -167,6 +320,7 @@ def main():
             handler_find_photos_with_same_article,
         ),
     )
+    dispatcher.add_handler(CommandHandler('find_duplicates', handler_find_duplicates))
     dispatcher.add_handler(CommandHandler('check_photos', check_photos))
     dispatcher.add_handler(CommandHandler('check_videos', check_videos))
 
@@ -176,6 +330,22 @@ def main():
 
     dispatcher.add_handler(CommandHandler('accept_media', accept_media))
 
+    dispatcher.add_handler(CommandHandler('jobs', jobs))
+    dispatcher.add_handler(CommandHandler('cancel_job', cancel_job))
+    dispatcher.add_handler(CommandHandler('stats', stats))
+    dispatcher.add_handler(CommandHandler('reset_barcode_cache', reset_barcode_cache))
+    if settings.PROFILING_ENABLED:
+        dispatcher.add_handler(CommandHandler('profile', profile))
+
+    for name, status in recover_batch_moves().items():
+        print(f'Interrupted move {name} recovered: {"rolled back" if status == "moving" else "completed"}')
+
+    on_warning = None
+    if settings.WATCHER_CHAT_ID:
+        on_warning = partial(updater.bot.send_message, settings.WATCHER_CHAT_ID)
+    media_watcher.start(on_warning)
+    metrics.start_server(settings.METRICS_PORT, settings.METRICS_HOST)
+
     updater.start_polling()
     updater.idle()
 
@@ -1,11 +1,18 @@
 import os
-import re
-import shutil
-
-import requests
 
+from barcode_cache import BarcodeLookup, barcode_cache
+from batch_move import BatchMove
 from env_settings import settings
-from pydantic_models import PhotoRenamingResponse
+from folder_snapshot import folder_snapshot, forget_folder_snapshot
+from jobs import check_cancelled
+from media_catalog import media_catalog
+from media_record import MediaRecord
+from tracing import traced
+
+
+def existing_barcodes(rows):
+    """Возвращает значения, с которыми сверяются штрихкоды файлов, из ответа 1С."""
+    return {row.name for row in rows.values() if row.name}
 
 
 class ValidationError(Exception):
@@ -16,14 +23,14 @@ class ValidationError(Exception):
         super().__init__(message)
 
 
-class MediaFile:
-    photo_pattern = r'^\d+_[123]\.jpeg$'
-    video_pattern = r'^\d+_v1\.mp4$'
+class MediaFile(MediaRecord):
+    __slots__ = ('parent',)
 
     def __init__(self, parent, file_name: str):
         self.parent = parent
-        self.file_name = file_name
-        self.barcode = file_name.split('_')[0]
+        self.set_file_name(file_name)
+        if self.barcode is None:
+            self.barcode = file_name.split('_')[0]
 
     def __eq__(self, other):
         if isinstance(other, str):
@@ -41,7 +48,7 @@ class MediaFile:
 
     @property
     def is_pattern_correct(self):
-        return re.match(self.photo_pattern, self.file_name) or re.match(self.video_pattern, self.file_name)
+        return self.kind is not None
 
     def report_wrong_pattern(self):
         return f'The filename {self.file_name} doesn\'t match the allowed patterns'
@@ -49,17 +56,11 @@ class MediaFile:
     def report_incorrect_barcode(self):
         return f'The barcode {repr(self.barcode)} from {repr(self.file_name)} doesn\'t exist in 1C'
 
-    def move(self, src_path, dst_path):
-        src = os.path.join(src_path, self.file_name)
-        dst = os.path.join(dst_path, self.file_name)
-        shutil.move(src, dst)
-
 class AcceptMedia:
-    def __init__(self):
+    def __init__(self, watcher=None):
+        self.watcher = watcher
+        self.prevalidated = {}
         self.media_sources_path = settings.MEDIA_SOURCES_PATH
-        self.url = settings.PHOTO_RENAMING_URL
-        self.login = settings.LOGIN_1C
-        self.password = settings.PASSWORD_1C
         self.src_photo_path = os.path.join(settings.MEDIA_SOURCES_PATH, 'PHOTO_TEAM', 'PHOTO')
         self.src_video_path = os.path.join(settings.MEDIA_SOURCES_PATH, 'PHOTO_TEAM', 'VIDEO')
         self.dst_photo_path = os.path.join(settings.MEDIA_SOURCES_PATH, 'SOURCES', 'PHOTO')
@@ -67,6 +68,8 @@ class AcceptMedia:
         self.photo_files = []
         self.video_files = []
         self.errors = []
+        self.barcode_lookup = BarcodeLookup({})
+        self.batch_move = BatchMove('accept_media')
 
     def __call__(self, *args, **kwargs):
         self.populate_photos()
@@ -74,6 +77,7 @@ class AcceptMedia:
         if not self.photo_files and not self.video_files:
             raise ValidationError('No new files to accept')
         # validate
+        self.collect_prevalidated()
         self.new_files_arent_existing_names()
         self.check_file_name_patterns()
         self.check_barcodes_exist()
@@ -81,45 +85,89 @@ class AcceptMedia:
         self.raise_for_errors()
         self.move_files()
 
+    @traced
     def populate_photos(self):
-        self.photo_files = [MediaFile(self, file_name) for file_name in os.listdir(self.src_photo_path)]
+        self.photo_files = [MediaFile(self, file_name) for file_name in folder_snapshot(self.src_photo_path).names]
 
+    @traced
     def populate_videos(self):
-        self.video_files = [MediaFile(self, file_name) for file_name in os.listdir(self.src_video_path)]
+        self.video_files = [MediaFile(self, file_name) for file_name in folder_snapshot(self.src_video_path).names]
 
+    @traced
     def new_files_arent_existing_names(self):
-        existing_filenames = os.listdir(self.dst_photo_path)
-        existing_filenames += os.listdir(self.dst_video_path)
+        existing_photos = folder_snapshot(self.dst_photo_path)
+        existing_videos = folder_snapshot(self.dst_video_path)
         for media_file in self.photo_files + self.video_files:
-            if media_file in existing_filenames:
+            if str(media_file) in existing_photos or str(media_file) in existing_videos:
                 self.errors.append(f'The file name {repr(str(media_file))} already exists in the source folder')
 
+    @traced
+    def collect_prevalidated(self):
+        """Берет у наблюдателя файлы, проверенные до вызова команды и с тех пор не изменившиеся."""
+        if not self.watcher or not self.watcher.enabled:
+            return
+        for kind, path in (('PHOTO', self.src_photo_path), ('VIDEO', self.src_video_path)):
+            for file_name, pending_file in self.watcher.ready_files(kind, folder_snapshot(path)).items():
+                self.prevalidated[(kind, file_name)] = pending_file
+
+    @traced
     def check_file_name_patterns(self):
         for media_file in self.photo_files + self.video_files:
             if not media_file.is_pattern_correct:
                 self.errors.append(media_file.report_wrong_pattern())
 
+    @traced
     def check_barcodes_exist(self):
-        barcodes = set([media_file.barcode for media_file in self.photo_files + self.video_files])
-        data = {'series': list(barcodes)}
-        response = requests.post(self.url, json=data, auth=(self.login, self.password))
-        response.raise_for_status()
-        request_result = PhotoRenamingResponse(response=response.json()).response
-        existing_barcodes = set([row.name for row in request_result if row.name])
-        for media_file in self.photo_files + self.video_files:
-            if media_file.barcode not in existing_barcodes:
+        """
+        Проверяет штрихкоды в 1С.
+
+        Штрихкоды, которые наблюдатель уже нашел в 1С, повторно не запрашиваются,
+        ненайденные запрашиваются заново: их могли завести после проверки.
+        """
+        media_files = [('PHOTO', media_file) for media_file in self.photo_files]
+        media_files += [('VIDEO', media_file) for media_file in self.video_files]
+        verified = set()
+        for kind, media_file in media_files:
+            pending_file = self.prevalidated.get((kind, str(media_file)))
+            if pending_file and pending_file.barcode_exists:
+                verified.add(media_file.barcode)
+        barcodes = {media_file.barcode for _, media_file in media_files} - verified
+        self.barcode_lookup = barcode_cache.lookup(barcodes)
+        existing = existing_barcodes(self.barcode_lookup.rows) | verified
+        for _, media_file in media_files:
+            if media_file.barcode not in existing:
                 self.errors.append(media_file.report_incorrect_barcode())
 
+    def report(self):
+        report = f'{self.batch_move.report()}\n{self.barcode_lookup.report()}'
+        if self.watcher and self.watcher.enabled:
+            files_number = len(self.photo_files) + len(self.video_files)
+            report += f'\nPrevalidated by the watcher: {len(self.prevalidated)}/{files_number}'
+        return report
+
     def raise_for_errors(self):
         if self.errors:
             raise ValidationError(self.errors)
 
+    @traced
     def move_files(self):
-        for photo_file in self.photo_files:
-            photo_file.move(self.src_photo_path, self.dst_photo_path)
-
-        for video_file in self.video_files:
-            video_file.move(self.src_video_path, self.dst_video_path)
+        """Переносит фото и видео одной пачкой: при ошибке не переносится ни один файл."""
+        check_cancelled()
+        pairs = [
+            (os.path.join(self.src_photo_path, str(photo_file)), os.path.join(self.dst_photo_path, str(photo_file)))
+            for photo_file in self.photo_files
+        ]
+        pairs += [
+            (os.path.join(self.src_video_path, str(video_file)), os.path.join(self.dst_video_path, str(video_file)))
+            for video_file in self.video_files
+        ]
+        catalog_current = {kind: media_catalog.is_current(kind) for kind in ('PHOTO', 'VIDEO')}
+        try:
+            self.batch_move.move(pairs)
+        finally:
+            forget_folder_snapshot(self.src_photo_path, self.src_video_path, self.dst_photo_path, self.dst_video_path)
+        media_catalog.add_files('PHOTO', [str(photo_file) for photo_file in self.photo_files], catalog_current['PHOTO'])
+        media_catalog.add_files('VIDEO', [str(video_file) for video_file in self.video_files], catalog_current['VIDEO'])
 
 
 if __name__ == '__main__':
@@ -0,0 +1,302 @@
+import os
+import time
+from contextlib import closing
+
+from barcode_cache import BarcodeLookup, barcode_cache
+from env_settings import settings
+from folder_snapshot import folder_snapshot
+from media_record import parse_file_name
+from state_files import StateDatabase, state_path
+
+QUERY_CHUNK_SIZE = 500
+STALE_1C_DATA = (
+    "(looked_up_at IS NULL OR looked_up_at < ? OR article IS NULL OR article = '' OR series IS NULL OR series = '')"
+)
+
+
+class CatalogRefresh:
+    """Итог обновления каталога: изменения файлов и статистика кэша штрихкодов."""
+
+    def __init__(self, files_number=0, added=0, changed=0, removed=0, barcode_lookup=None):
+        self.files_number = files_number
+        self.added = added
+        self.changed = changed
+        self.removed = removed
+        self.barcode_lookup = barcode_lookup or BarcodeLookup({})
+
+    def report(self):
+        return (
+            f'Catalog: {self.files_number} files, +{self.added} ~{self.changed} -{self.removed}\n'
+            f'{self.barcode_lookup.report()}'
+        )
+
+
+class MediaCatalog(StateDatabase):
+    """
+    Каталог файлов SOURCES с данными 1С в SQLite.
+
+    При обновлении папка сравнивается с прошлым сканированием: новые
+    и измененные файлы перечитываются, пропавшие удаляются. В 1С
+    запрашиваются только штрихкоды новых файлов, ненайденные штрихкоды
+    и данные старше BARCODE_CACHE_TTL. Команды делают запросы к каталогу
+    вместо повторного разбора папки.
+    """
+
+    schema = (
+        'CREATE TABLE IF NOT EXISTS files ('
+        'kind TEXT NOT NULL, '
+        'file_name TEXT NOT NULL, '
+        'barcode TEXT, '
+        'angle INTEGER, '
+        'created_at REAL, '
+        'size INTEGER, '
+        'modified_at INTEGER, '
+        'article TEXT, '
+        'aim TEXT, '
+        'series TEXT, '
+        'metal TEXT, '
+        'diagnostics TEXT, '
+        'looked_up_at REAL, '
+        'PRIMARY KEY (kind, file_name));'
+        'CREATE INDEX IF NOT EXISTS files_article ON files (kind, article);'
+        'CREATE INDEX IF NOT EXISTS files_barcode ON files (kind, barcode);'
+        'CREATE TABLE IF NOT EXISTS folders (kind TEXT PRIMARY KEY, modified_at INTEGER NOT NULL);'
+    )
+
+    def __init__(self, path, media_sources_path, ttl):
+        super().__init__(path)
+        self.media_sources_path = media_sources_path
+        self.ttl = ttl
+
+    def folder_path(self, kind):
+        return os.path.join(self.media_sources_path, 'SOURCES', kind)
+
+    def refresh(self, kind):
+        """
+        Приводит каталог папки SOURCES/kind в соответствие с диском.
+
+        Запрос к 1С выполняется вне блокировки и транзакции каталога,
+        данные 1С записываются отдельной транзакцией после ответа.
+        """
+        snapshot = folder_snapshot(self.folder_path(kind))
+        now = time.time()
+        with self.lock, closing(self.connect()) as connection, connection:
+            result = self.store_folder(connection, kind, snapshot)
+            barcodes = {
+                barcode for barcode, in connection.execute(
+                    f'SELECT DISTINCT barcode FROM files WHERE kind = ? AND barcode IS NOT NULL AND {STALE_1C_DATA}',
+                    (kind, now - self.ttl),
+                )
+            }
+        result.barcode_lookup = self.update_1c_data(kind, barcodes, now)
+        return result
+
+    def refresh_barcodes(self, kind, barcodes):
+        """
+        Перезапрашивает в 1С данные файлов с указанными штрихкодами, если они устарели или не найдены.
+
+        Нужна, когда папка не менялась и refresh не вызывается: данные 1С
+        устаревают и без изменений на диске.
+        """
+        now = time.time()
+        stale_barcodes = set()
+        for barcodes_chunk in chunked(list(barcodes)):
+            placeholders = ', '.join('?' * len(barcodes_chunk))
+            stale_barcodes.update(
+                barcode for barcode, in self.query(
+                    f'SELECT DISTINCT barcode FROM files WHERE kind = ? AND barcode IN ({placeholders}) '
+                    f'AND {STALE_1C_DATA}',
+                    (kind, *barcodes_chunk, now - self.ttl),
+                )
+            )
+        return self.update_1c_data(kind, stale_barcodes, now)
+
+    def update_1c_data(self, kind, barcodes, now):
+        """Запрашивает штрихкоды в 1С вне блокировки и записывает ответ отдельной транзакцией."""
+        if not barcodes:
+            return BarcodeLookup({})
+        barcode_lookup = barcode_cache.lookup(barcodes)
+        with self.lock, closing(self.connect()) as connection, connection:
+            self.store_1c_data(connection, kind, barcodes, barcode_lookup.rows, now)
+        return barcode_lookup
+
+    def store_folder(self, connection, kind, snapshot):
+        """Записывает новые и измененные файлы снимка папки, удаляет пропавшие."""
+        known = {
+            file_name: (size, modified_at)
+            for file_name, size, modified_at in connection.execute(
+                'SELECT file_name, size, modified_at FROM files WHERE kind = ?', (kind,),
+            )
+        }
+        entries = [entry for entry in snapshot if entry.name != '.DS_Store']
+        result = CatalogRefresh(files_number=len(entries))
+        upserts = []
+        for entry in entries:
+            stat = entry.stat()
+            previous = known.pop(entry.name, None)
+            if previous == (stat.st_size, stat.st_mtime_ns):
+                continue
+            if previous is None:
+                result.added += 1
+            else:
+                result.changed += 1
+            upserts.append(file_row(kind, entry.name, stat))
+        connection.executemany(
+            'INSERT INTO files (kind, file_name, barcode, angle, created_at, size, modified_at) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?) '
+            'ON CONFLICT (kind, file_name) DO UPDATE SET '
+            'barcode = excluded.barcode, angle = excluded.angle, created_at = excluded.created_at, '
+            'size = excluded.size, modified_at = excluded.modified_at, looked_up_at = NULL',
+            upserts,
+        )
+        connection.executemany(
+            'DELETE FROM files WHERE kind = ? AND file_name = ?', [(kind, file_name) for file_name in known],
+        )
+        result.removed = len(known)
+        connection.execute(
+            'INSERT OR REPLACE INTO folders (kind, modified_at) VALUES (?, ?)', (kind, snapshot.modified_at),
+        )
+        return result
+
+    def is_current(self, kind):
+        """
+        Проверяет, что папка не менялась после последнего обновления каталога.
+
+        Любое добавление, удаление или переименование файла меняет время
+        изменения папки, поэтому достаточно одного stat вместо сканирования.
+        """
+        rows = self.query('SELECT modified_at FROM folders WHERE kind = ?', (kind,))
+        return bool(rows) and rows[0][0] == os.stat(self.folder_path(kind)).st_mtime_ns
+
+    def add_files(self, kind, file_names, mark_current=False):
+        """
+        Добавляет в каталог файлы, перенесенные ботом в SOURCES, за время, пропорциональное их числу.
+
+        Если каталог был актуален до переноса, он отмечается актуальным и после.
+        """
+        folder_path = self.folder_path(kind)
+        now = time.time()
+        rows = []
+        for file_name in file_names:
+            record = parse_file_name(file_name)
+            if record.kind != kind:
+                continue
+            stat = os.stat(os.path.join(folder_path, file_name))
+            rows.append(
+                (kind, file_name, record.barcode, record.angle, stat.st_ctime, stat.st_size, stat.st_mtime_ns),
+            )
+        barcodes = {row[2] for row in rows}
+        barcode_lookup = barcode_cache.lookup(barcodes) if barcodes else BarcodeLookup({})
+        with self.lock, closing(self.connect()) as connection, connection:
+            connection.executemany(
+                'INSERT OR REPLACE INTO files (kind, file_name, barcode, angle, created_at, size, modified_at) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                rows,
+            )
+            self.store_1c_data(connection, kind, barcodes, barcode_lookup.rows, now)
+            if mark_current:
+                connection.execute(
+                    'INSERT OR REPLACE INTO folders (kind, modified_at) VALUES (?, ?)',
+                    (kind, os.stat(folder_path).st_mtime_ns),
+                )
+        return barcode_lookup
+
+    def store_1c_data(self, connection, kind, barcodes, rows, now):
+        updates = []
+        for barcode in barcodes:
+            row = rows.get(barcode)
+            if row:
+                updates.append((row.article, row.aim, row.name, row.metal, row.diagnostics, now, kind, barcode))
+            else:
+                updates.append((None, None, None, None, None, now, kind, barcode))
+        connection.executemany(
+            'UPDATE files SET article = ?, aim = ?, series = ?, metal = ?, diagnostics = ?, looked_up_at = ? '
+            'WHERE kind = ? AND barcode = ?',
+            updates,
+        )
+
+    def forget_1c_data(self, barcodes=None):
+        """Помечает данные 1С штрихкодов устаревшими, без аргументов - всех; они запросятся при следующем обновлении."""
+        with self.lock, closing(self.connect()) as connection, connection:
+            if barcodes is None:
+                connection.execute('UPDATE files SET looked_up_at = NULL')
+            else:
+                connection.executemany(
+                    'UPDATE files SET looked_up_at = NULL WHERE barcode = ?', [(barcode,) for barcode in barcodes],
+                )
+
+    def query(self, sql, parameters=()):
+        with self.lock, closing(self.connect()) as connection:
+            return connection.execute(sql, parameters).fetchall()
+
+    def wrong_file_names(self, kind):
+        return [
+            file_name for file_name, in self.query(
+                'SELECT file_name FROM files WHERE kind = ? AND barcode IS NULL ORDER BY file_name', (kind,),
+            )
+        ]
+
+    def unknown_barcode_file_names(self, kind):
+        return [
+            file_name for file_name, in self.query(
+                'SELECT file_name FROM files WHERE kind = ? AND barcode IS NOT NULL '
+                "AND (series IS NULL OR series = '') ORDER BY file_name",
+                (kind,),
+            )
+        ]
+
+    def articles_with_multiple_barcodes(self, kind):
+        """Возвращает артикул -> отсортированные имена файлов для артикулов с несколькими штрихкодами."""
+        result = {}
+        rows = self.query(
+            'SELECT files.article, files.file_name FROM files '
+            'JOIN (SELECT article FROM files WHERE kind = ? GROUP BY article '
+            'HAVING COUNT(DISTINCT barcode) > 1) duplicates ON files.article IS duplicates.article '
+            'WHERE files.kind = ? ORDER BY files.article, files.file_name',
+            (kind, kind),
+        )
+        for article, file_name in rows:
+            result.setdefault(article, []).append(file_name)
+        return result
+
+    def files_with_articles(self, kind, articles):
+        """
+        Возвращает (имя файла, артикул) файлов с указанными артикулами.
+
+        Найденные файлы проверяются на диске: пропавшие удаляются из каталога
+        и в результат не попадают.
+        """
+        rows = []
+        for articles_chunk in chunked(sorted(articles)):
+            placeholders = ', '.join('?' * len(articles_chunk))
+            rows += self.query(
+                f'SELECT file_name, article FROM files WHERE kind = ? AND article IN ({placeholders}) '
+                'ORDER BY article, file_name',
+                (kind, *articles_chunk),
+            )
+        folder_path = self.folder_path(kind)
+        missing = [file_name for file_name, _ in rows if not os.path.exists(os.path.join(folder_path, file_name))]
+        if missing:
+            with self.lock, closing(self.connect()) as connection, connection:
+                connection.executemany(
+                    'DELETE FROM files WHERE kind = ? AND file_name = ?', [(kind, file_name) for file_name in missing],
+                )
+        missing = set(missing)
+        return [(file_name, article) for file_name, article in rows if file_name not in missing]
+
+
+def chunked(items, size=QUERY_CHUNK_SIZE):
+    """Делит список на части, чтобы число параметров запроса не превышало лимит SQLite."""
+    return [items[index:index + size] for index in range(0, len(items), size)]
+
+
+def file_row(kind, file_name, stat):
+    """Строка таблицы files; у файлов с неверным именем нет штрихкода и ракурса."""
+    record = parse_file_name(file_name)
+    barcode, angle = (record.barcode, record.angle) if record.kind == kind else (None, None)
+    return kind, file_name, barcode, angle, stat.st_ctime, stat.st_size, stat.st_mtime_ns
+
+
+media_catalog = MediaCatalog(
+    state_path('media_catalog.sqlite3'), settings.MEDIA_SOURCES_PATH, settings.BARCODE_CACHE_TTL,
+)
@@ -0,0 +1,46 @@
+import re
+
+PHOTO = 'PHOTO'
+VIDEO = 'VIDEO'
+
+# <штрихкод>_<ракурс 1-3>.jpeg для фото и <штрихкод>_v1.mp4 для видео
+MEDIA_FILE_NAME = re.compile(r'^(\d+)_(?:([123])\.jpeg|v(1)\.mp4)$')
+
+
+class MediaRecord:
+    """
+    Разобранное имя медиафайла.
+
+    kind - PHOTO или VIDEO, у имени не по шаблону kind, barcode и angle равны None.
+    Записи используют __slots__, поэтому на 100k+ файлов занимают в разы меньше памяти, чем словари.
+    """
+
+    __slots__ = ('file_name', 'kind', 'barcode', 'angle')
+
+    def __init__(self, file_name, kind=None, barcode=None, angle=None):
+        self.file_name = file_name
+        self.kind = kind
+        self.barcode = barcode
+        self.angle = angle
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}({self.file_name!r}, {self.kind!r}, {self.barcode!r}, {self.angle!r})'
+
+    def set_file_name(self, file_name):
+        """Разбирает имя за один проход скомпилированным выражением."""
+        self.file_name = file_name
+        match = MEDIA_FILE_NAME.match(file_name)
+        if match is None:
+            self.kind = self.barcode = self.angle = None
+            return
+        self.barcode, photo_angle, video_angle = match.groups()
+        if photo_angle:
+            self.kind, self.angle = PHOTO, int(photo_angle)
+        else:
+            self.kind, self.angle = VIDEO, int(video_angle)
+
+
+def parse_file_name(file_name):
+    record = MediaRecord(file_name)
+    record.set_file_name(file_name)
+    return record
@@ -0,0 +1,232 @@
+import ctypes
+import ctypes.util
+import os
+import select
+import threading
+import time
+
+from barcode_cache import barcode_cache
+from env_settings import settings
+from folder_snapshot import FolderSnapshot
+from media_accept import MediaFile, existing_barcodes
+
+# Файлы, изменявшиеся последние секунды, еще копируются и проверяются при следующем сканировании
+SETTLE_SECONDS = 2
+
+
+class Inotify:
+    """Минимальная обертка над inotify через ctypes: сообщает, что в папках что-то изменилось."""
+
+    IN_MODIFY = 0x2
+    IN_CLOSE_WRITE = 0x8
+    IN_MOVED_FROM = 0x40
+    IN_MOVED_TO = 0x80
+    IN_CREATE = 0x100
+    IN_DELETE = 0x200
+    mask = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+
+    def __init__(self, paths):
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        self.fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        for path in paths:
+            if libc.inotify_add_watch(self.fd, os.fsencode(path), self.mask) < 0:
+                errno = ctypes.get_errno()
+                os.close(self.fd)
+                raise OSError(errno, f'inotify_add_watch failed for {path}')
+
+    def wait(self, timeout):
+        """Ждет событий не дольше timeout секунд и вычитывает их все."""
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return False
+        try:
+            while os.read(self.fd, 64 * 1024):
+                pass
+        except BlockingIOError:
+            pass
+        return True
+
+
+class PendingFile:
+    """Файл из PHOTO_TEAM, уже проверенный наблюдателем."""
+
+    def __init__(self, kind, file_name, size, modified_at):
+        self.kind = kind
+        self.file_name = file_name
+        self.size = size
+        self.modified_at = modified_at
+        self.media_file = MediaFile(None, file_name)
+        self.barcode_exists = None
+        self.errors = []
+
+    def matches(self, stat):
+        """Проверяет, что файл не изменился после проверки."""
+        return (self.size, self.modified_at) == (stat.st_size, stat.st_mtime_ns)
+
+
+class MediaWatcher:
+    """
+    Наблюдает за PHOTO_TEAM/PHOTO и PHOTO_TEAM/VIDEO и проверяет файлы по мере появления.
+
+    Новые и измененные файлы проверяются на шаблон имени, совпадение имени
+    с SOURCES и наличие штрихкода в 1С. Штрихкоды запрашиваются через кэш,
+    поэтому /accept_media переиспользует ответы 1С. inotify только будит
+    наблюдателя раньше: папки все равно пересканируются каждые poll_interval секунд,
+    так как на сетевых папках события приходят не всегда.
+    """
+
+    def __init__(self, media_sources_path, mode, poll_interval):
+        self.folders = {
+            kind: os.path.join(media_sources_path, 'PHOTO_TEAM', kind) for kind in ('PHOTO', 'VIDEO')
+        }
+        self.sources = {
+            kind: os.path.join(media_sources_path, 'SOURCES', kind) for kind in ('PHOTO', 'VIDEO')
+        }
+        self.mode = mode
+        self.poll_interval = poll_interval
+        self.files = {kind: {} for kind in self.folders}
+        self.lock = threading.Lock()
+        self.inotify = None
+        self.on_warning = None
+        self.thread = None
+
+    @property
+    def enabled(self):
+        return self.mode != 'off'
+
+    def start(self, on_warning=None):
+        if not self.enabled or self.thread:
+            return
+        self.on_warning = on_warning
+        self.inotify = self.open_inotify()
+        self.thread = threading.Thread(target=self.run, name='media-watcher', daemon=True)
+        self.thread.start()
+
+    def open_inotify(self):
+        """Подключает inotify; в режиме auto, если он недоступен, остается только опрос папок."""
+        if self.mode not in ('auto', 'inotify'):
+            return None
+        try:
+            return Inotify(self.folders.values())
+        except (OSError, AttributeError):
+            if self.mode == 'inotify':
+                raise
+            return None
+
+    def run(self):
+        while True:
+            try:
+                self.scan()
+            except Exception as e:
+                self.warn(f'Media watcher error: {e}')
+            if self.inotify:
+                self.inotify.wait(self.poll_interval)
+            else:
+                time.sleep(self.poll_interval)
+
+    def scan(self):
+        warnings = []
+        for kind, path in self.folders.items():
+            warnings.extend(self.scan_folder(kind, path))
+        if warnings:
+            self.warn('\n'.join(warnings))
+
+    def scan_folder(self, kind, path):
+        """Проверяет новые и измененные файлы папки и возвращает найденные ошибки."""
+        try:
+            snapshot = FolderSnapshot(path)
+        except FileNotFoundError:
+            return []
+        with self.lock:
+            known = self.files[kind]
+        current, new_files = self.compare(kind, snapshot, known)
+        self.validate(kind, new_files)
+        warnings = []
+        for pending_file in new_files:
+            current[pending_file.file_name] = pending_file
+            warnings.extend(pending_file.errors)
+        with self.lock:
+            self.files[kind] = current
+        return warnings
+
+    @staticmethod
+    def compare(kind, snapshot, known):
+        """Разделяет дописанные файлы папки на уже проверенные (имя -> файл) и новые или измененные."""
+        current = {}
+        new_files = []
+        for entry in snapshot:
+            stat = settled_stat(entry)
+            if stat is None:
+                continue
+            previous = known.get(entry.name)
+            if previous and previous.matches(stat):
+                current[entry.name] = previous
+            else:
+                new_files.append(PendingFile(kind, entry.name, stat.st_size, stat.st_mtime_ns))
+        return current, new_files
+
+    def validate(self, kind, pending_files):
+        correct_files = self.check_names(kind, pending_files)
+        if correct_files:
+            self.check_barcodes(correct_files)
+
+    def check_names(self, kind, pending_files):
+        """Проверяет шаблон имени и совпадение с SOURCES, возвращает файлы с правильным именем."""
+        correct_files = []
+        for pending_file in pending_files:
+            media_file = pending_file.media_file
+            if os.path.exists(os.path.join(self.sources[kind], pending_file.file_name)):
+                pending_file.errors.append(
+                    f'The file name {repr(pending_file.file_name)} already exists in the source folder',
+                )
+            if media_file.is_pattern_correct:
+                correct_files.append(pending_file)
+            else:
+                pending_file.errors.append(media_file.report_wrong_pattern())
+        return correct_files
+
+    @staticmethod
+    def check_barcodes(pending_files):
+        barcode_lookup = barcode_cache.lookup({pending_file.media_file.barcode for pending_file in pending_files})
+        existing = existing_barcodes(barcode_lookup.rows)
+        for pending_file in pending_files:
+            pending_file.barcode_exists = pending_file.media_file.barcode in existing
+            if not pending_file.barcode_exists:
+                pending_file.errors.append(pending_file.media_file.report_incorrect_barcode())
+
+    def ready_files(self, kind, snapshot):
+        """Возвращает имя -> проверенный файл для файлов, не изменившихся после проверки."""
+        with self.lock:
+            known = self.files[kind]
+        ready = {}
+        for entry in snapshot:
+            pending_file = known.get(entry.name)
+            if pending_file is None:
+                continue
+            if pending_file.matches(entry.stat()):
+                ready[entry.name] = pending_file
+        return ready
+
+    def warn(self, text):
+        print(text)
+        if self.on_warning:
+            try:
+                self.on_warning(text[:4096])
+            except Exception as e:
+                print(f'Media watcher could not send a warning: {e}')
+
+
+def settled_stat(entry):
+    """Возвращает stat файла, если его уже дописали, иначе None."""
+    try:
+        stat = entry.stat()
+    except FileNotFoundError:
+        return None
+    return None if time.time() - stat.st_mtime < SETTLE_SECONDS else stat
+
+
+media_watcher = MediaWatcher(
+    settings.MEDIA_SOURCES_PATH, settings.MEDIA_WATCHER, settings.MEDIA_WATCHER_POLL_INTERVAL,
+)
@@ -0,0 +1,217 @@
+import math
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from env_settings import settings
+from file_links import format_size
+
+DURATION_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800)
+SIZE_BUCKETS = (1024, 16 * 1024, 128 * 1024, 1024 ** 2, 8 * 1024 ** 2, 64 * 1024 ** 2, 512 * 1024 ** 2)
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    pairs = ','.join(
+        '{}="{}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for name, value in labels
+    )
+    return f'{{{pairs}}}'
+
+
+def format_value(value):
+    if value == math.inf:
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    kind = 'counter'
+
+    def __init__(self, name, description):
+        self.name = name
+        self.description = description
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def inc(self, value=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + value
+
+    def samples(self):
+        with self.lock:
+            values = dict(self.values)
+        for key, value in sorted(values.items()):
+            yield self.name, key, value
+
+
+class Histogram:
+    """Гистограмма с накопительными корзинами, как в клиентах Prometheus."""
+
+    kind = 'histogram'
+
+    def __init__(self, name, description, buckets):
+        self.name = name
+        self.description = description
+        self.buckets = (*buckets, math.inf)
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            counts, total = self.values.get(key, ([0] * len(self.buckets), 0))
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[index] += 1
+                    break
+            self.values[key] = (counts, total + value)
+
+    def series(self):
+        """Возвращает метки -> (накопительные счетчики корзин, сумма)."""
+        with self.lock:
+            values = {key: (list(counts), total) for key, (counts, total) in self.values.items()}
+        result = {}
+        for key, (counts, total) in values.items():
+            cumulative = []
+            for count in counts:
+                cumulative.append(count + (cumulative[-1] if cumulative else 0))
+            result[key] = (cumulative, total)
+        return result
+
+    def samples(self):
+        for key, (cumulative, total) in sorted(self.series().items()):
+            for bound, count in zip(self.buckets, cumulative):
+                yield f'{self.name}_bucket', (*key, ('le', format_value(bound))), count
+            yield f'{self.name}_sum', key, total
+            yield f'{self.name}_count', key, cumulative[-1]
+
+    def quantile(self, key, quantile):
+        """Оценивает квантиль верхней границей корзины, в которую он попал."""
+        cumulative, _ = self.series()[key]
+        rank = quantile * cumulative[-1]
+        for bound, count in zip(self.buckets, cumulative):
+            if count >= rank:
+                return bound
+        return math.inf
+
+
+class Metrics:
+    """Метрики бота в памяти процесса; отдаются в текстовом формате Prometheus и командой /stats."""
+
+    def __init__(self):
+        self.job_duration = Histogram(
+            'bot_job_duration_seconds', 'Duration of bot commands run as jobs', DURATION_BUCKETS,
+        )
+        self.request_1c_duration = Histogram(
+            'bot_1c_request_duration_seconds', 'Latency of 1C requests by endpoint', DURATION_BUCKETS,
+        )
+        self.response_1c_size = Histogram(
+            'bot_1c_response_bytes', 'Size of 1C response bodies by endpoint', SIZE_BUCKETS,
+        )
+        self.request_1c_sent = Counter('bot_1c_request_bytes_total', 'Bytes sent to 1C by endpoint')
+        self.files_scanned = Counter('bot_files_scanned_total', 'Directory entries read by folder')
+        self.bytes_copied = Counter('bot_bytes_copied_total', 'Bytes copied by operation')
+        self.bytes_resized = Counter('bot_bytes_resized_total', 'Source bytes read by resize')
+        self.started_at = time.time()
+        self.server = None
+
+    @property
+    def all_metrics(self):
+        return (
+            self.job_duration, self.request_1c_duration, self.response_1c_size, self.request_1c_sent,
+            self.files_scanned, self.bytes_copied, self.bytes_resized,
+        )
+
+    def render(self):
+        lines = []
+        for metric in self.all_metrics:
+            lines.append(f'# HELP {metric.name} {metric.description}')
+            lines.append(f'# TYPE {metric.name} {metric.kind}')
+            for name, labels, value in metric.samples():
+                lines.append(f'{name}{format_labels(labels)} {format_value(value)}')
+        return '\n'.join(lines) + '\n'
+
+    def report(self):
+        """Краткая сводка для /stats: число запусков, среднее и p95 по командам и точкам 1С."""
+        lines = [f'Uptime {(time.time() - self.started_at) / 3600:.1f} h']
+        for title, histogram in (('Commands', self.job_duration), ('1C requests', self.request_1c_duration)):
+            lines.extend(report_histogram(title, histogram))
+        for title, counter, format_count in (
+            ('Files scanned', self.files_scanned, str), ('Bytes copied', self.bytes_copied, format_size),
+            ('Bytes resized', self.bytes_resized, format_size), ('Bytes sent to 1C', self.request_1c_sent, format_size),
+        ):
+            lines.extend(report_counter(title, counter, format_count))
+        return '\n'.join(lines)
+
+    def start_server(self, port, host='127.0.0.1'):
+        """Поднимает HTTP-сервер метрик в фоновом потоке, port 0 - не поднимать."""
+        if not port or self.server:
+            return
+        self.server = ThreadingHTTPServer((host, port), MetricsHandler)
+        threading.Thread(target=self.server.serve_forever, name='metrics', daemon=True).start()
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):  # noqa: N802
+        if self.path.split('?')[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        body = metrics.render().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):  # noqa: A002
+        pass
+
+
+def report_histogram(title, histogram):
+    series = histogram.series()
+    if not series:
+        return []
+    lines = [f'\n{title}:']
+    for key, (cumulative, total) in sorted(series.items()):
+        labels = ' '.join(str(value) for _, value in key)
+        count = cumulative[-1]
+        lines.append(f'{labels}: {count}, avg {total / count:.2f} s, p95 <= {histogram.quantile(key, 0.95):g} s')
+    return lines
+
+
+def report_counter(title, counter, format_count):
+    samples = list(counter.samples())
+    if not samples:
+        return []
+    return [f'\n{title}:'] + [
+        f'{" ".join(str(label) for _, label in key) or "-"}: {format_count(value)}' for _, key, value in samples
+    ]
+
+
+def count_files_scanned(path, files_number):
+    """Учитывает прочитанные записи папки; папки внутри MEDIA_SOURCES_PATH помечаются относительным путем."""
+    relative_path = os.path.relpath(path, settings.MEDIA_SOURCES_PATH)
+    folder = os.path.basename(path) if relative_path.startswith('..') else relative_path
+    metrics.files_scanned.inc(files_number, folder=folder)
+
+
+def timed_request(endpoint, send, *args, **kwargs):
+    """Выполняет запрос к 1С через send и записывает его время, статус и размеры."""
+    start = time.perf_counter()
+    status = 'error'
+    try:
+        response = send(*args, **kwargs)
+        status = str(response.status_code)
+        metrics.response_1c_size.observe(len(response.content), endpoint=endpoint)
+        body = response.request.body if response.request else None
+        metrics.request_1c_sent.inc(len(body or b''), endpoint=endpoint)
+        return response
+    finally:
+        metrics.request_1c_duration.observe(time.perf_counter() - start, endpoint=endpoint, status=status)
+
+
+metrics = Metrics()
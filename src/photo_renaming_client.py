@@ -0,0 +1,58 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from env_settings import settings
+from metrics import timed_request
+from pydantic_models import PhotoRenamingResponse
+
+
+class PhotoRenamingClient:
+    """Запрашивает у 1С штрихкоды частями в несколько параллельных запросов."""
+
+    def __init__(self, url, user, password, chunk_size, parallelism, timeout):
+        self.url = url
+        self.auth = (user, password)
+        self.chunk_size = max(chunk_size, 1)
+        self.parallelism = max(parallelism, 1)
+        self.timeout = timeout
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.parallelism)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def lookup(self, barcodes):
+        """Возвращает словарь ШК -> строка ответа 1С."""
+        series = sorted(set(barcodes))
+        chunks = [
+            series[index:index + self.chunk_size]
+            for index in range(0, len(series), self.chunk_size)
+        ]
+        result = {}
+        for rows in self.request_chunks(chunks):
+            result.update({row.barcode: row for row in rows})
+        return result
+
+    def request_chunks(self, chunks):
+        if len(chunks) <= 1:
+            return [self.request_chunk(chunk) for chunk in chunks]
+        with ThreadPoolExecutor(max_workers=min(self.parallelism, len(chunks))) as executor:
+            return list(executor.map(self.request_chunk, chunks))
+
+    def request_chunk(self, chunk):
+        response = timed_request(
+            'photo_renaming', self.session.post, self.url, json={'series': chunk}, auth=self.auth, timeout=self.timeout,
+        )
+        response.raise_for_status()
+        return PhotoRenamingResponse(response=response.json()).response
+
+
+photo_renaming_client = PhotoRenamingClient(
+    settings.PHOTO_RENAMING_URL,
+    settings.LOGIN_1C,
+    settings.PASSWORD_1C,
+    chunk_size=settings.PHOTO_RENAMING_CHUNK_SIZE,
+    parallelism=settings.PHOTO_RENAMING_PARALLELISM,
+    timeout=settings.PHOTO_RENAMING_TIMEOUT,
+)
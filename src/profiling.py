@@ -0,0 +1,81 @@
+import cProfile
+import io
+import marshal
+import pstats
+import threading
+import tracemalloc
+from contextlib import contextmanager
+from functools import partial
+
+from telegram.error import TelegramError
+
+local = threading.local()
+
+
+class ProfileRequest:
+    """Запрос /profile: куда отправить профиль, нужно ли трассировать память и сколько строк показать."""
+
+    def __init__(self, message, command, trace_memory, top):
+        self.message = message
+        self.command = command
+        self.trace_memory = trace_memory
+        self.top = top
+        self.submitted = False
+
+
+@contextmanager
+def profile_submissions(request):
+    """Задачи, поставленные в очередь внутри блока в этом потоке, выполняются под профилировщиком."""
+    local.request = request
+    try:
+        yield request
+    finally:
+        local.request = None
+
+
+def profiled(func):
+    """Оборачивает func профилировщиком, если задачу ставит команда /profile, иначе возвращает ее как есть."""
+    request = getattr(local, 'request', None)
+    if request is None:
+        return func
+    request.submitted = True
+    return partial(run_profiled, request, func)
+
+
+def run_profiled(request, func):
+    profiler = cProfile.Profile()
+    trace_memory = request.trace_memory and not tracemalloc.is_tracing()
+    if trace_memory:
+        tracemalloc.start()
+    profiler.enable()
+    try:
+        return func()
+    finally:
+        profiler.disable()
+        snapshot = None
+        if trace_memory:
+            snapshot = tracemalloc.take_snapshot()
+            tracemalloc.stop()
+        send_profile(request, profiler, snapshot)
+
+
+def format_profile(profiler, snapshot, top):
+    stream = io.StringIO()
+    stats = pstats.Stats(profiler, stream=stream)
+    stats.sort_stats(pstats.SortKey.CUMULATIVE).print_stats(top)
+    stats.sort_stats(pstats.SortKey.TIME).print_stats(top)
+    if snapshot is not None:
+        stream.write(f'Top {top} allocations by line:\n')
+        for statistic in snapshot.statistics('lineno')[:top]:
+            stream.write(f'{statistic}\n')
+    return stream.getvalue()
+
+
+def send_profile(request, profiler, snapshot):
+    text = format_profile(profiler, snapshot, request.top)
+    profiler.create_stats()
+    try:
+        request.message.reply_document(io.BytesIO(text.encode()), f'profile_{request.command}.txt')
+        request.message.reply_document(io.BytesIO(marshal.dumps(profiler.stats)), f'profile_{request.command}.prof')
+    except TelegramError as e:
+        print(f'Profile of {request.command} was not sent: {e}')
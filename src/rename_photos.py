@@ -1,30 +1,42 @@
 import os
-import re
-import shutil
 import time
+from collections import Counter
 from io import BytesIO
 
-import requests
 from telegram import Update
 
+from barcode_cache import BarcodeLookup, barcode_cache
+from bulk_copy import BulkCopy
+from content_hashes import content_index
 from env_settings import settings
+from file_links import format_size, place_file
+from folder_snapshot import folder_snapshot, forget_folder_snapshot
+from jobs import check_cancelled
+from media_record import MediaRecord
+from metrics import metrics
+from state_files import load_json, save_json, state_path
+from tracing import trace_report, traced
+
+
+class RenameRow(MediaRecord):
+    """Строка таблицы переименования: разобранное имя, данные файла и ответ 1С."""
+
+    __slots__ = ('created_at', 'size', 'modified_at', 'aim', 'series', 'metal', 'reason')
+
+    def __init__(self, file_name, kind, stat):
+        self.set_file_name(file_name)
+        if self.kind != kind:
+            self.kind = self.barcode = self.angle = None
+        self.created_at = stat.st_ctime
+        self.size = stat.st_size
+        self.modified_at = stat.st_mtime_ns
+        self.aim = None
+        self.series = None
+        self.metal = None
+        self.reason = None
 
 
 class TablePhotoRename:
-    url = settings.PHOTO_RENAMING_URL
-    user = settings.LOGIN_1C
-    password = settings.PASSWORD_1C
-
-    columns = (
-        'file_name',
-        'created_at',
-        'barcode',
-        'angle',
-        'aim',
-        'series',
-        'metal',
-        'reason',
-    )
     result_fields = (
         'wrong_file_names',
         'wrong_barcodes',
@@ -33,6 +45,13 @@ class TablePhotoRename:
         'renaming_duration',
         'photo_number_after',
         'series_without_aim',
+        'barcode_cache',
+        'copied_number',
+        'skipped_number',
+        'deleted_number',
+        'link_strategy',
+        'bytes_saved',
+        'copy_report',
     )
 
     def __init__(self, document):
@@ -42,74 +61,65 @@ class TablePhotoRename:
         self.kind = document.kind
         self.table = []
         if self.kind == 'PHOTO':
-            self.pattern = r'^\d+_[123]\.jpeg$'
             self.extension = 'jpeg'
         elif self.kind == 'VIDEO':
-            self.pattern = r'^\d+_v1\.mp4$'
             self.extension = 'mp4'
         self.response_json = None
+        self.barcode_lookup = BarcodeLookup({})
         self.wrong_file_names = None
         self.wrong_barcodes = None
         self.aim_table = []
         self.photo_number_before = 0
         self.renaming_duration = ''
         self.photo_number_after = 0
+        self.copied_number = 0
+        self.skipped_number = 0
+        self.deleted_number = 0
+        self.link_strategy = Counter()
+        self.bytes_saved = 0
+        self.bulk_copy = BulkCopy(verb='placed')
+        self.manifest_path = state_path(f'rename_manifest_{self.kind.lower()}.json')
 
+    @traced
     def populate_table(self):
-        for file_name in os.listdir(self.src_path):
-            if file_name == '.DS_Store':
+        for entry in folder_snapshot(self.src_path):
+            if entry.name == '.DS_Store':
                 continue
+            self.table.append(RenameRow(entry.name, self.kind, entry.stat()))
 
-            new_row = {column: None for column in self.columns}
-            new_row['file_name'] = file_name
-            new_row['created_at'] = os.path.getctime(
-                os.path.join(self.src_path, file_name),
-            )
-
-            if re.match(self.pattern, file_name):
-                name, _extension = file_name.split('.')
-                barcode, angle = name.split('_')
-                angle = angle.replace('v', '')
-
-                new_row['barcode'] = barcode
-                new_row['angle'] = int(angle)
-
-            self.table.append(new_row)
-
+    @traced
     def make_request(self):
         unique_series = {
-            file_name['barcode']
+            file_name.barcode
             for file_name in self.table
-            if file_name['barcode']
+            if file_name.barcode
         }
-        data = {'series': list(unique_series)}
-        response = requests.post(self.url, json=data, auth=(self.user, self.password))
-        response.raise_for_status()
-        self.response_json = response.json()
+        self.barcode_lookup = barcode_cache.lookup(unique_series)
+        self.response_json = self.barcode_lookup.rows
 
+    @traced
     def join_response_json(self):
         for row in self.table:
-            barcode = row['barcode']
+            barcode = row.barcode
             if not barcode:
                 continue
-            found_dict = next(
-                item
-                for item in self.response_json
-                if item.get('ШК') == barcode
-            )
-            row['aim'] = found_dict['Трим_Аим']
-            row['series'] = found_dict['Наименование']
-            row['metal'] = found_dict['Металл']
-            row['reason'] = found_dict['Диагностика']
+            found_row = self.response_json.get(barcode)
+            if not found_row:
+                continue
+            row.aim = found_row.aim
+            row.series = found_row.name
+            row.metal = found_row.metal
+            row.reason = found_row.diagnostics
 
+    @traced
     def validate_table(self):
         self.wrong_file_names = [
-            row['file_name'] for row in self.table if not row['barcode']
+            row.file_name for row in self.table if not row.barcode
         ]
         self.wrong_barcodes = [
-            row['file_name']
+            row.file_name
             for row in self.table
-            if row['barcode'] and not row['series']
+            if row.barcode and not row.series
         ]
 
     @property
@@ -126,16 +136,24 @@ class TablePhotoRename:
             response['wrong_barcodes'] = ', '.join(self.wrong_barcodes)
         if self.response_json:
             response['series_without_aim'] = [
-                row for row in self.table if not row['aim']
+                row for row in self.table if not row.aim
             ]
         response['photo_number_before'] = self.photo_number_before
         response['renaming_duration'] = self.renaming_duration
         response['photo_number_after'] = self.photo_number_after
+        response['barcode_cache'] = self.barcode_lookup.report()
+        response['copied_number'] = self.copied_number
+        response['skipped_number'] = self.skipped_number
+        response['deleted_number'] = self.deleted_number
+        response['link_strategy'] = dict(self.link_strategy)
+        response['bytes_saved'] = self.bytes_saved
+        response['copy_report'] = self.bulk_copy.report()
 
         return response
 
+    @traced
     def create_aim_table(self):
-        unique_aims = {row['aim'] for row in self.table if row['aim']}
+        unique_aims = {row.aim for row in self.table if row.aim}
 
         for aim in unique_aims:
             new_row_aim = {
@@ -145,62 +163,142 @@ class TablePhotoRename:
                 'angle3': [],
             }
             for file_name in self.table:
-                if file_name['aim'] != aim:
+                if file_name.aim != aim:
                     continue
-                if file_name['angle'] == 1:
+                if file_name.angle == 1:
                     new_row_aim['angle1'].append(file_name)
-                elif file_name['angle'] == 2:
+                elif file_name.angle == 2:
                     new_row_aim['angle2'].append(file_name)
-                elif file_name['angle'] == 3:
+                elif file_name.angle == 3:
                     new_row_aim['angle3'].append(file_name)
 
             new_row_aim['angle1'].sort(
-                key=lambda x: x['created_at'], reverse=True,
+                key=lambda x: x.created_at, reverse=True,
             )
             new_row_aim['angle2'].sort(
-                key=lambda x: x['created_at'], reverse=True,
+                key=lambda x: x.created_at, reverse=True,
             )
             new_row_aim['angle3'].sort(
-                key=lambda x: x['created_at'], reverse=True,
+                key=lambda x: x.created_at, reverse=True,
             )
             self.aim_table.append(new_row_aim)
 
+    @traced
     def rename(self):
-        self.photo_number_before = len(os.listdir(self.dst_path))
-        self.empty_destination()
+        snapshot = folder_snapshot(self.dst_path)
+        self.photo_number_before = len(snapshot)
         start = time.time()
-        for aim in self.aim_table:
-            if aim['angle1']:
-                photo_file = aim['angle1'][0]
-                src = os.path.join(self.src_path, photo_file['file_name'])
-                if self.kind == 'PHOTO':
-                    new_file_name = f'{aim["aim"]}_1.{self.extension}'
-                elif self.kind == 'VIDEO':
-                    new_file_name = f'{aim["aim"]}_v1.{self.extension}'
-                dst = os.path.join(self.dst_path, new_file_name)
-                shutil.copy2(src, dst)
-            if aim['angle2']:
-                photo_file = aim['angle2'][0]
-                src = os.path.join(self.src_path, photo_file['file_name'])
-                new_file_name = f'{aim["aim"]}_2.{self.extension}'
-                dst = os.path.join(self.dst_path, new_file_name)
-                shutil.copy2(src, dst)
-            if aim['angle3']:
-                photo_file = aim['angle3'][0]
-                src = os.path.join(self.src_path, photo_file['file_name'])
-                new_file_name = f'{aim["aim"]}_3.{self.extension}'
-                dst = os.path.join(self.dst_path, new_file_name)
-                shutil.copy2(src, dst)
+        targets = self.get_targets()
+        if settings.RENAME_INCREMENTAL:
+            self.sync_targets(targets, snapshot)
+        else:
+            self.empty_destination(snapshot.names)
+            self.copy_targets(targets.items())
+            self.copied_number = len(targets)
+            self.deleted_number = len(snapshot)
+            self.save_manifest(targets, {})
         end = time.time()
         self.renaming_duration = f'{end - start:.0f}'
-        self.photo_number_after = len(os.listdir(self.dst_path))
+        # В обоих режимах в папке назначения остаются ровно целевые файлы
+        self.photo_number_after = len(targets)
+        forget_folder_snapshot(self.dst_path)
+
+    def get_targets(self):
+        """Возвращает новое имя файла -> самый свежий файл ракурса аима."""
+        return {
+            self.target_name(aim['aim'], angle): aim[f'angle{angle}'][0]
+            for aim in self.aim_table
+            for angle in (1, 2, 3)
+            if aim[f'angle{angle}']
+        }
+
+    def target_name(self, aim, angle):
+        suffix = 'v1' if self.kind == 'VIDEO' and angle == 1 else angle
+        return f'{aim}_{suffix}.{self.extension}'
+
+    def copy_targets(self, targets):
+        """Размещает файлы параллельно, targets - пары (новое имя, файл-исходник)."""
+        targets = list(targets)
+        strategies = self.bulk_copy.run(
+            self.copy_target, [(photo_file.size, photo_file, new_file_name) for new_file_name, photo_file in targets],
+        )
+        for (_, photo_file), strategy in zip(targets, strategies):
+            self.link_strategy[strategy] += 1
+            if strategy == 'copy':
+                metrics.bytes_copied.inc(photo_file.size, operation='rename')
+            else:
+                self.bytes_saved += photo_file.size
+
+    def copy_target(self, photo_file, new_file_name):
+        """Выполняется в потоке пула BulkCopy и возвращает использованную стратегию."""
+        src = os.path.join(self.src_path, photo_file.file_name)
+        dst = os.path.join(self.dst_path, new_file_name)
+        strategy = place_file(src, dst, settings.RENAME_LINK_MODE)
+        if settings.VERIFY_COPIES:
+            content_index.verify_copy(src, dst, strategy)
+        return strategy
+
+    def sync_targets(self, targets, snapshot):
+        """
+        Синхронизирует папку назначения с целевым набором файлов.
+
+        Копируются только новые или изменившиеся файлы, удаляются только
+        файлы, которых больше нет в целевом наборе. Манифест хранит для
+        каждого целевого файла исходник, его размер и время изменения,
+        а также размер и время изменения копии: копия, измененная не ботом,
+        размещается заново.
+        """
+        manifest = load_json(self.manifest_path, {})
+        copied_files = manifest.get('files', {}) if manifest.get('dst_path') == self.dst_path else {}
+        existing_files = {entry.name: entry.stat() for entry in snapshot}
+        changed_targets = self.changed_targets(targets, copied_files, existing_files)
+        self.skipped_number = len(targets) - len(changed_targets)
+        self.copy_targets(changed_targets)
+        self.copied_number = len(changed_targets)
+        for file_name in existing_files.keys() - targets.keys():
+            os.remove(os.path.join(self.dst_path, file_name))
+            self.deleted_number += 1
+        changed_names = {new_file_name for new_file_name, _ in changed_targets}
+        self.save_manifest(
+            targets,
+            {file_name: stat for file_name, stat in existing_files.items() if file_name not in changed_names},
+        )
+
+    @staticmethod
+    def changed_targets(targets, copied_files, existing_files):
+        """Возвращает пары (новое имя, исходник), которых нет в папке или чей исходник или копия изменились."""
+        changed_targets = []
+        for new_file_name, photo_file in targets.items():
+            check_cancelled()
+            stat = existing_files.get(new_file_name)
+            if stat is None or copied_files.get(new_file_name) != manifest_entry(photo_file, stat):
+                changed_targets.append((new_file_name, photo_file))
+        return changed_targets
 
-    def empty_destination(self):
-        for file_name in os.listdir(self.dst_path):
+    def save_manifest(self, targets, copy_stats):
+        """Записывает манифест целевых файлов; copy_stats - известные stat копий, остальные читаются с диска."""
+        files = {}
+        for new_file_name, photo_file in targets.items():
+            stat = copy_stats.get(new_file_name) or os.stat(os.path.join(self.dst_path, new_file_name))
+            files[new_file_name] = manifest_entry(photo_file, stat)
+        save_json(self.manifest_path, {'dst_path': self.dst_path, 'files': files})
+
+    def empty_destination(self, existing_names):
+        for file_name in existing_names:
             full_path = os.path.join(self.dst_path, file_name)
             os.remove(full_path)
 
 
+def manifest_entry(photo_file, copy_stat):
+    return {
+        'source': photo_file.file_name,
+        'size': photo_file.size,
+        'modified_at': photo_file.modified_at,
+        'copy_size': copy_stat.st_size,
+        'copy_modified_at': copy_stat.st_mtime_ns,
+    }
+
+
 class DocumentPhotoRename:
     def __init__(self, src_path, dst_path, kind):
         self.kind = kind
@@ -214,8 +312,6 @@ class DocumentPhotoRename:
         table.make_request()
         table.join_response_json()
         table.validate_table()
-        if table.has_errors:
-            self.result = table.get_result()
         table.create_aim_table()
         table.rename()
         self.result = table.get_result()
@@ -239,9 +335,8 @@ class RenamePhotos:
         document.start()
         self.result = document.result
         if self.result['exception']:
-            self.report_errors()
-        else:
-            self.send_result()
+            return self.report_errors()
+        return self.send_result()
 
     def report_errors(self):
         self.temp_message.edit_text('Renaming failed.')
@@ -255,11 +350,23 @@ class RenamePhotos:
                 BytesIO(self.result['wrong_barcodes'].encode()),
                 'wrong_barcodes.txt',
             )
+        return 'Renaming failed, see wrong_file_names.txt and wrong_barcodes.txt.'
 
     def send_result(self):
-        self.temp_message.edit_text(
+        strategies = ', '.join(
+            f'{strategy} {number}' for strategy, number in self.result['link_strategy'].items()
+        )
+        text = (
             'The renaming operation was successfully completed.\n'
             f'It took {self.result["renaming_duration"]} seconds.\n'
             f'Before the operation, the destination folder contained {self.result["photo_number_before"]} files, '
-            f'and it has {self.result["photo_number_after"]} files afterward.',
+            f'and it has {self.result["photo_number_after"]} files afterward.\n'
+            f'Copied {self.result["copied_number"]}, skipped {self.result["skipped_number"]}, '
+            f'deleted {self.result["deleted_number"]} files.\n'
+            f'Strategy: {strategies or "-"}, saved {format_size(self.result["bytes_saved"])}.\n'
+            f'{self.result["copy_report"]}.\n'
+            f'{self.result["barcode_cache"]}'
+            f'{trace_report()}'
         )
+        self.temp_message.edit_text(text)
+        return text
@@ -1,9 +1,213 @@
+import hashlib
+import math
+import multiprocessing
 import os
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from io import BytesIO
 
-from PIL import Image
+from PIL import Image, ImageChops, ImageStat
 from telegram import Update
 
 from env_settings import settings
+from file_links import format_size, remove_if_exists
+from jobs import JobCancelledError, check_cancelled, report_progress
+from metrics import count_files_scanned, metrics
+from state_files import load_json, save_json, state_path
+from tracing import trace_report, traced
+
+# Сначала уменьшение в целое число раз через reduce(), затем LANCZOS на последних RESIZE_REDUCING_GAP крат
+RESIZE_REDUCING_GAP = 3.0
+# Формат в sizes.txt -> (формат Pillow, расширение, параметры сохранения)
+OUTPUT_FORMATS = {
+    'jpeg': ('JPEG', 'jpeg', {'quality': 90, 'optimize': True, 'progressive': True}),
+    'webp': ('WEBP', 'webp', {'quality': 85, 'method': 4}),
+    'avif': ('AVIF', 'avif', {'quality': 60, 'speed': 6}),
+}
+# С этим JPEG сравнивается объем копий каждого формата при RESIZE_QUALITY_CHECK
+BASELINE_JPEG = {'quality': 90}
+
+
+def available_formats():
+    """Форматы, которые установленный Pillow умеет сохранять: AVIF нужен кодек libavif."""
+    Image.init()
+    return {name for name, (pil_format, _, _) in OUTPUT_FORMATS.items() if pil_format in Image.SAVE}
+
+
+def parse_derivatives(lines, formats):
+    """
+    Разбирает sizes.txt: строка - размер и форматы копий, например `100x100 jpeg webp avif`.
+
+    Размер без форматов означает jpeg. Возвращает список (размер, формат)
+    и форматы, пропущенные из-за отсутствия кодека.
+    """
+    requested = [derivative for line in lines for derivative in parse_sizes_line(line)]
+    derivatives = list(dict.fromkeys(derivative for derivative in requested if derivative[1] in formats))
+    skipped_formats = {output_format for _, output_format in requested if output_format not in formats}
+    return derivatives, skipped_formats
+
+
+def parse_sizes_line(line):
+    """Возвращает (размер, формат) копий из строки sizes.txt, комментарии после # пропускаются."""
+    fields = line.split('#', 1)[0].split()
+    if not fields:
+        return []
+    size = tuple(int(side) for side in fields[0].split('x'))
+    return [(size, output_format) for output_format in parse_formats(fields[1:])]
+
+
+def parse_formats(names):
+    output_formats = [name.lower() for name in names or ['jpeg']]
+    for output_format in output_formats:
+        if output_format not in OUTPUT_FORMATS:
+            raise ValueError(f'Unknown format {output_format!r} in sizes.txt, use {", ".join(OUTPUT_FORMATS)}')
+    return output_formats
+
+
+def output_names(src_file_path, derivatives):
+    """Возвращает пути уменьшенных копий исходника относительно папки назначения."""
+    filename = os.path.basename(src_file_path).split('.')[0]
+    return [
+        f'{width}x{height}/{filename}.{OUTPUT_FORMATS[output_format][1]}'
+        for (width, height), output_format in derivatives
+    ]
+
+
+def draft_for_sizes(img, sizes, max_image_bytes):
+    """
+    Включает для JPEG декодирование с уменьшением в DCT.
+
+    Масштаб выбирается так, чтобы декодированное изображение было не меньше
+    самого большого запрошенного размера, а при превышении лимита памяти
+    уменьшается дальше. Возвращает объем памяти декодированного изображения.
+    """
+    width, height = img.size
+    bands = len(img.getbands())
+    largest_width = max(size[0] for size in sizes)
+    largest_height = max(size[1] for size in sizes)
+    scale = 1
+    while scale < 8 and width // (scale * 2) >= largest_width and height // (scale * 2) >= largest_height:
+        scale *= 2
+    while scale < 8 and -(-width // scale) * -(-height // scale) * bands > max_image_bytes:
+        scale *= 2
+    if img.format == 'JPEG':
+        img.draft(img.mode, (width // scale, height // scale))
+    return img.size[0] * img.size[1] * bands
+
+
+def resize_cascade(img, sizes):
+    """Уменьшает изображение от большего размера к меньшему, каждый раз из предыдущего результата."""
+    resized_images = {}
+    previous = img
+    for size in sorted(sizes, key=lambda size: size[0] * size[1], reverse=True):
+        previous = previous.resize(size, Image.LANCZOS, reducing_gap=RESIZE_REDUCING_GAP)
+        resized_images[size] = previous
+    return resized_images
+
+
+def compare_with_reference(data, sizes, resized_images):
+    """Возвращает худший PSNR (дБ) относительно полного LANCZOS по исходнику без draft."""
+    worst_psnr = math.inf
+    with Image.open(BytesIO(data)) as reference_source:
+        reference_source.load()
+        for size in sizes:
+            reference = reference_source.resize(size, Image.LANCZOS)
+            rms = ImageStat.Stat(ImageChops.difference(reference, resized_images[size])).rms
+            mse = sum(band_rms ** 2 for band_rms in rms) / len(rms)
+            if mse:
+                worst_psnr = min(worst_psnr, 10 * math.log10(255 ** 2 / mse))
+    return worst_psnr
+
+
+def encode(img, output_format):
+    pil_format, _, options = OUTPUT_FORMATS[output_format]
+    if pil_format != 'JPEG' and img.mode not in ('RGB', 'RGBA'):
+        img = img.convert('RGB')
+    buffer = BytesIO()
+    img.save(buffer, pil_format, **options)
+    return buffer.getvalue()
+
+
+def resize_file(src_file_path, dst_path, derivatives, previous_hash=None, max_image_bytes=None, quality_check=False):
+    """
+    Декодирует исходник один раз, уменьшает до каждого размера один раз и кодирует во все форматы размера.
+
+    Возвращает хэш содержимого, признак того, что копии были пересозданы,
+    худший PSNR относительно полного LANCZOS, если включена проверка качества,
+    формат -> (байт в копиях, байт в baseline JPEG тех же размеров или 0 без проверки)
+    и копия -> байт в ней. Если содержимое совпадает с previous_hash, файл не обрабатывается.
+    """
+    sizes = list(dict.fromkeys(size for size, _ in derivatives))
+    with open(src_file_path, 'rb') as file:
+        data = file.read()
+    content_hash = hashlib.blake2b(data, digest_size=16).hexdigest()
+    if content_hash == previous_hash:
+        return content_hash, False, None, {}, {}
+    with Image.open(BytesIO(data)) as img:
+        image_bytes = draft_for_sizes(img, sizes, max_image_bytes or math.inf)
+        if max_image_bytes and image_bytes > max_image_bytes:
+            raise ValueError(
+                f'{src_file_path} needs {image_bytes // 1024 // 1024} MB to decode, '
+                f'the limit is {max_image_bytes // 1024 // 1024} MB',
+            )
+        img.load()
+        resized_images = resize_cascade(img, sizes)
+    format_bytes, output_sizes = write_derivatives(src_file_path, dst_path, derivatives, resized_images, quality_check)
+    psnr = compare_with_reference(data, sizes, resized_images) if quality_check else None
+    return content_hash, True, psnr, format_bytes, output_sizes
+
+
+def write_derivatives(src_file_path, dst_path, derivatives, resized_images, quality_check):
+    """
+    Кодирует и записывает копии исходника, возвращает объем копий по форматам и по именам.
+
+    С проверкой качества каждый размер дополнительно кодируется в baseline JPEG,
+    чтобы сравнить с ним объем копий: формат -> (байт в копиях, байт в baseline).
+    """
+    baseline_bytes = {}
+    format_bytes = {}
+    output_sizes = {}
+    for (size, output_format), output_name in zip(derivatives, output_names(src_file_path, derivatives)):
+        output = encode(resized_images[size], output_format)
+        with open(f'{dst_path}/{output_name}', 'wb') as file:
+            file.write(output)
+        output_sizes[output_name] = len(output)
+        if quality_check and size not in baseline_bytes:
+            baseline_bytes[size] = len(encode_baseline(resized_images[size]))
+        written, baseline_written = format_bytes.get(output_format, (0, 0))
+        format_bytes[output_format] = (written + len(output), baseline_written + baseline_bytes.get(size, 0))
+    return format_bytes, output_sizes
+
+
+def encode_baseline(img):
+    buffer = BytesIO()
+    img.save(buffer, 'JPEG', **BASELINE_JPEG)
+    return buffer.getvalue()
+
+
+def resize_chunk(tasks, dst_path, derivatives, max_image_bytes, quality_check):
+    return [
+        (
+            src_file_path,
+            *resize_file(src_file_path, dst_path, derivatives, previous_hash, max_image_bytes, quality_check),
+        )
+        for src_file_path, previous_hash in tasks
+    ]
+
+
+def output_format_of(output_name):
+    """Формат копии по расширению ее имени."""
+    extension = output_name.rsplit('.', 1)[-1]
+    return next(name for name, (_, format_extension, _) in OUTPUT_FORMATS.items() if format_extension == extension)
+
+
+def format_savings(written, reference_written, reference_name):
+    """Экономия против эталонного объема; если сравнивать не с чем, строка пустая."""
+    if not reference_written:
+        return ''
+    saved = reference_written - written
+    change = f'saved {format_size(saved)}' if saved >= 0 else f'grew by {format_size(-saved)}'
+    return f', {change} ({abs(saved) / reference_written * 100:.0f}%) against {reference_name}'
 
 
 class DocumentResizePhotos:
@@ -11,32 +215,222 @@ class DocumentResizePhotos:
         self.src_path = src_path
         self.dst_path = dst_path
         self.sizes = None
+        self.derivatives = None
+        self.skipped_formats = set()
+        self.format_bytes = {}
+        self.previous_bytes = {}
+        self.sizes_signature = None
+        self.workers = settings.RESIZE_WORKERS or os.cpu_count()
+        self.chunk_size = max(settings.RESIZE_CHUNK_SIZE, 1)
+        self.max_inflight_bytes = settings.RESIZE_MAX_INFLIGHT_MB * 1024 * 1024
+        self.max_image_bytes = settings.RESIZE_MAX_IMAGE_MB * 1024 * 1024
+        self.quality_check = settings.RESIZE_QUALITY_CHECK
+        self.worst_psnr = math.inf
+        self.manifest_path = state_path('resize_manifest.json')
+        self.manifest = {}
+        self.bytes_number = 0
+        self.duration = 0
+        self.processed_number = 0
+        self.skipped_number = 0
+        self.pruned_number = 0
 
     def prepare_sizes_list(self):
         current_file_path = os.path.abspath(__file__)
         current_dir_path = os.path.dirname(current_file_path)
         sizes_path = os.path.join(current_dir_path, 'sizes.txt')
         with open(sizes_path, 'r') as file:
-            self.sizes = [row.strip().split('x') for row in file.readlines()]
+            self.derivatives, self.skipped_formats = parse_derivatives(file.readlines(), available_formats())
+        if not self.derivatives:
+            raise ValueError('sizes.txt has no sizes with available formats')
+        self.sizes = list(dict.fromkeys(size for size, _ in self.derivatives))
+        self.sizes_signature = ','.join(
+            f'{width}x{height} {output_format}' for (width, height), output_format in self.derivatives
+        )
 
     def prepare_folders(self):
-        for size in self.sizes:
-            folder_name = f'{size[0]}x{size[1]}'
-            folder_path = f'{self.dst_path}/{folder_name}'
+        for width, height in self.sizes:
+            folder_path = f'{self.dst_path}/{width}x{height}'
             os.makedirs(folder_path, exist_ok=True)
 
-    def resize(self):
+    def load_manifest(self):
+        """
+        Загружает манифест прошлого запуска.
+
+        Манифест сопоставляет исходнику его размер, время изменения, хэш содержимого,
+        созданные копии и их объем. При изменении sizes.txt хэши сбрасываются, чтобы все
+        исходники были обработаны заново, а копии прежних размеров удалены.
+        """
+        manifest = load_json(self.manifest_path, {})
+        if manifest.get('dst_path') != self.dst_path:
+            return {}
+        sources = manifest.get('sources', {})
+        if manifest.get('sizes') != self.sizes_signature:
+            for entry in sources.values():
+                entry['hash'] = None
+                entry['modified_at'] = None
+        return sources
+
+    def save_manifest(self):
+        save_json(self.manifest_path, {
+            'dst_path': self.dst_path,
+            'sizes': self.sizes_signature,
+            'sources': self.manifest,
+        })
+
+    @traced
+    def collect_sources(self):
+        """Возвращает словарь путь -> (размер, время изменения) исходников."""
+        sources = {}
         for root, _, files in os.walk(self.src_path):
             for file in files:
-                filename, file_extension = file.split('.')
+                if file == '.DS_Store':
+                    continue
                 src_file_path = f'{root}/{file}'
-                for size in self.sizes:
-                    folder_name = f'{size[0]}x{size[1]}'
-                    folder_path = f'{self.dst_path}/{folder_name}'
-                    dst_file_path = f'{folder_path}/{filename}.jpeg'
-                    img = Image.open(src_file_path)
-                    img = img.resize((int(size[0]), int(size[1])), Image.LANCZOS)
-                    img.save(dst_file_path, 'JPEG', quality=90)
+                stat = os.stat(src_file_path)
+                sources[src_file_path] = (stat.st_size, stat.st_mtime_ns)
+        count_files_scanned(self.src_path, len(sources))
+        return sources
+
+    def make_chunks(self, tasks):
+        return [
+            tasks[index:index + self.chunk_size]
+            for index in range(0, len(tasks), self.chunk_size)
+        ]
+
+    def resize(self):
+        """
+        Уменьшает новые и измененные исходники в пуле процессов.
+
+        Исходники отправляются воркерам пачками, суммарный объем
+        еще не обработанных пачек не превышает max_inflight_bytes.
+        Копии удаленных исходников удаляются.
+        """
+        start = time.perf_counter()
+        self.manifest = self.load_manifest()
+        sources = self.collect_sources()
+        tasks = []
+        for src_file_path, (size, modified_at) in sources.items():
+            entry = self.manifest.get(src_file_path)
+            if entry and entry['size'] == size and entry['modified_at'] == modified_at:
+                self.skipped_number += 1
+                continue
+            tasks.append((src_file_path, size, modified_at, entry['hash'] if entry else None))
+        try:
+            self.run_tasks(tasks)
+        finally:
+            self.save_manifest()
+        self.prune(sources)
+        self.save_manifest()
+        self.duration = time.perf_counter() - start
+
+    @traced
+    def run_tasks(self, tasks):
+        if not tasks:
+            return
+        context = multiprocessing.get_context('forkserver')
+        stats = {src_file_path: (size, modified_at) for src_file_path, size, modified_at, _ in tasks}
+        with ProcessPoolExecutor(max_workers=self.workers, mp_context=context) as executor:
+            in_flight = {}
+            try:
+                for chunk in self.make_chunks(tasks):
+                    chunk_bytes = sum(size for _, size, _, _ in chunk)
+                    while in_flight and sum(in_flight.values()) + chunk_bytes > self.max_inflight_bytes:
+                        self.collect_finished(in_flight, stats)
+                    chunk_tasks = [(src_file_path, previous_hash) for src_file_path, _, _, previous_hash in chunk]
+                    future = executor.submit(
+                        resize_chunk,
+                        chunk_tasks, self.dst_path, self.derivatives, self.max_image_bytes, self.quality_check,
+                    )
+                    in_flight[future] = chunk_bytes
+                while in_flight:
+                    self.collect_finished(in_flight, stats)
+            except JobCancelledError:
+                executor.shutdown(cancel_futures=True)
+                raise
+
+    def collect_finished(self, in_flight, stats):
+        check_cancelled()
+        done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+        report_progress(f'{self.processed_number} of {len(stats)} photos')
+        for future in done:
+            chunk_bytes = in_flight.pop(future)
+            for src_file_path, content_hash, processed, psnr, format_bytes, output_sizes in future.result():
+                previous_sizes = self.manifest.get(src_file_path, {}).get('output_sizes', {})
+                self.record_stats(psnr, format_bytes, output_sizes, previous_sizes)
+                self.record_result(src_file_path, content_hash, processed, stats[src_file_path], output_sizes)
+            self.bytes_number += chunk_bytes
+            metrics.bytes_resized.inc(chunk_bytes)
+
+    def record_result(self, src_file_path, content_hash, processed, stat, output_sizes):
+        """Записывает обработанный исходник в манифест."""
+        size, modified_at = stat
+        previous_entry = self.manifest.get(src_file_path, {})
+        self.manifest[src_file_path] = {
+            'size': size,
+            'modified_at': modified_at,
+            'hash': content_hash,
+            'outputs': sorted(
+                set(previous_entry.get('outputs', [])) | set(output_names(src_file_path, self.derivatives)),
+            ),
+            'output_sizes': {**previous_entry.get('output_sizes', {}), **output_sizes},
+        }
+        if processed:
+            self.processed_number += 1
+        else:
+            self.skipped_number += 1
+
+    def record_stats(self, psnr, format_bytes, output_sizes, previous_sizes):
+        """Учитывает в отчете качество и объем копий исходника, в том числе против копий прошлого запуска."""
+        if psnr is not None:
+            self.worst_psnr = min(self.worst_psnr, psnr)
+        for output_format, (written, baseline_written) in format_bytes.items():
+            total, baseline_total = self.format_bytes.get(output_format, (0, 0))
+            self.format_bytes[output_format] = (total + written, baseline_total + baseline_written)
+        for output_name in output_sizes.keys() & previous_sizes.keys():
+            output_format = output_format_of(output_name)
+            total, previous_total = self.previous_bytes.get(output_format, (0, 0))
+            self.previous_bytes[output_format] = (
+                total + output_sizes[output_name], previous_total + previous_sizes[output_name],
+            )
+
+    @traced
+    def prune(self, sources):
+        """Удаляет копии исходников, которых больше нет, и копии прежних размеров."""
+        current_outputs = {
+            output_name
+            for src_file_path in sources
+            for output_name in output_names(src_file_path, self.derivatives)
+        }
+        for src_file_path in list(self.manifest):
+            entry = self.manifest[src_file_path]
+            outputs = set(entry['outputs']) - current_outputs
+            if src_file_path not in sources:
+                del self.manifest[src_file_path]
+                self.pruned_number += 1
+            for output_name in outputs:
+                remove_if_exists(f'{self.dst_path}/{output_name}')
+            entry['outputs'] = [output for output in entry['outputs'] if output not in outputs]
+            entry['output_sizes'] = {
+                output: size for output, size in entry.get('output_sizes', {}).items() if output not in outputs
+            }
+
+    def report(self):
+        duration = max(self.duration, 0.001)
+        megabytes = self.bytes_number / 1024 / 1024
+        report = (
+            f'Processed {self.processed_number}, skipped {self.skipped_number}, pruned {self.pruned_number}.\n'
+            f'{megabytes:.1f} MB in {self.duration:.0f} sec.\n'
+            f'{self.processed_number / duration:.1f} images/s, {megabytes / duration:.1f} MB/s'
+        )
+        for output_format, (written, baseline_written) in self.format_bytes.items():
+            report += f'\n{output_format}: {format_size(written)}'
+            report += format_savings(*self.previous_bytes.get(output_format, (0, 0)), 'previous outputs')
+            report += format_savings(written, baseline_written, f'baseline JPEG q{BASELINE_JPEG["quality"]}')
+        if self.skipped_formats:
+            report += f'\nSkipped, no codec: {", ".join(sorted(self.skipped_formats))}'
+        if self.quality_check and self.processed_number:
+            report += f'\nWorst PSNR against full LANCZOS: {self.worst_psnr:.1f} dB'
+        return report
 
 
 class ResizePhotos:
@@ -54,6 +448,10 @@ class ResizePhotos:
             document.prepare_sizes_list()
             document.prepare_folders()
             document.resize()
-            self.temp_message.reply_text('Resizing completed.')
+            text = f'Resizing completed.\n{document.report()}{trace_report()}'
+        except JobCancelledError:
+            raise
         except Exception as e:
-            self.temp_message.reply_text(f'Error: {e}')
+            text = f'Error: {e}'
+        self.temp_message.reply_text(text)
+        return text
@@ -0,0 +1,80 @@
+import json
+import os
+import sqlite3
+import threading
+
+from env_settings import settings
+
+
+def state_path(file_name):
+    """Возвращает путь к файлу в папке локального состояния бота."""
+    return os.path.join(settings.STATE_PATH, file_name)
+
+
+def load_json(path, default):
+    """Читает JSON-файл состояния, при отсутствии или порче возвращает default."""
+    try:
+        with open(path, 'r', encoding='utf-8') as file:
+            return json.load(file)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return default
+
+
+def save_json(path, data, durable=False):
+    """
+    Атомарно записывает JSON-файл состояния.
+
+    С durable=True файл и папка сбрасываются на диск до возврата,
+    так записываются журналы, которые должны пережить падение процесса.
+    """
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    temp_path = f'{path}.tmp'
+    with open(temp_path, 'w', encoding='utf-8') as file:
+        json.dump(data, file, ensure_ascii=False)
+        if durable:
+            file.flush()
+            os.fsync(file.fileno())
+    os.replace(temp_path, path)
+    if durable:
+        fsync_folder(os.path.dirname(path) or '.')
+
+
+def fsync_folder(path):
+    folder_fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(folder_fd)
+    finally:
+        os.close(folder_fd)
+
+
+def fsync_file(path):
+    file_fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(file_fd)
+    finally:
+        os.close(file_fd)
+
+
+class StateDatabase:
+    """
+    База SQLite в папке состояния бота.
+
+    При первом подключении создаются папка базы и схема из schema.
+    Подключения открываются на время операции под self.lock.
+    """
+
+    schema = ''
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.initialized = False
+
+    def connect(self):
+        if not self.initialized:
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        connection = sqlite3.connect(self.path)
+        if not self.initialized:
+            connection.executescript(self.schema)
+            self.initialized = True
+        return connection
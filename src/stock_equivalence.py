@@ -1,9 +1,23 @@
+import csv
+import gzip
+import io
+import itertools
 import json
-from time import perf_counter
+import threading
+from collections import Counter, OrderedDict
+from concurrent.futures import Future
+from time import localtime, monotonic, perf_counter, strftime
 
 import requests
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
 
 from env_settings import settings
+from jobs import JobCancelledError
+from metrics import timed_request
+from stock_snapshots import diff_rows, snapshot_store
+from tracing import traced
+
+MESSAGE_LIMIT = 4096
 
 
 # Когда через кнопку, то колбек и меняем наше сообщение, пишем, что выполняется.
@@ -13,41 +27,229 @@ from env_settings import settings
 # Потом опять его меняем пишем сколько заняло плюс еще одно сообщение с результатом
 
 
+class StockEquivalenceCache:
+    """
+    Кэш ответов сверки по режиму запроса (с обновлением или без).
+
+    Пока запрос к 1С по режиму выполняется, остальные вызовы с тем же режимом
+    ждут его результат, а не отправляют в 1С такой же запрос.
+    """
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self.entries = {}
+        self.in_flight = {}
+        self.lock = threading.Lock()
+
+    def get(self, update_1c_required, fetch, force_refresh=False):
+        """
+        Возвращает ответ, его возраст в секундах и признак, что запрос к 1С выполнил этот вызов.
+
+        Возраст None - ответ свежий: получен этим вызовом или запросом, к которому вызов присоединился.
+        """
+        with self.lock:
+            entry = self.entries.get(update_1c_required)
+            if entry and not force_refresh and monotonic() - entry[0] < self.ttl:
+                return entry[1], monotonic() - entry[0], False
+            future = self.in_flight.get(update_1c_required)
+            owner = future is None
+            if owner:
+                future = Future()
+                self.in_flight[update_1c_required] = future
+        if not owner:
+            return future.result(), None, False
+        return self.fetch(update_1c_required, future, fetch), None, True
+
+    def fetch(self, update_1c_required, future, fetch):
+        """Выполняет запрос к 1С и передает результат или ошибку присоединившимся вызовам."""
+        try:
+            data = fetch()
+        except BaseException as e:
+            # Отмена задачи или прерывание касаются только этого вызова, ожидающим передается обычная ошибка
+            interrupted = not isinstance(e, Exception) or isinstance(e, JobCancelledError)
+            future.set_exception(RuntimeError('The 1C request was interrupted') if interrupted else e)
+            raise
+        else:
+            with self.lock:
+                self.entries[update_1c_required] = (monotonic(), data)
+            future.set_result(data)
+        finally:
+            with self.lock:
+                del self.in_flight[update_1c_required]
+        return data
+
+
+stock_equivalence_cache = StockEquivalenceCache(settings.STOCK_EQUIVALENCE_CACHE_TTL)
+
+
+def discrepancy_rows(data):
+    """
+    Приводит ответ сверки к списку строк-словарей.
+
+    Списки внутри ответа-словаря разворачиваются в строки с полем section,
+    равным ключу списка; остальные значения становятся строками key/value.
+    """
+    if isinstance(data, list):
+        return [row if isinstance(row, dict) else {'value': row} for row in data]
+    if not isinstance(data, dict):
+        return [{'value': data}]
+    return [row for key, value in data.items() for row in section_rows(key, value)]
+
+
+def section_rows(key, value):
+    """Строки одного значения ответа-словаря."""
+    if not isinstance(value, list):
+        return [{'key': key, 'value': value}]
+    return [{'section': key, **row} if isinstance(row, dict) else {'section': key, 'value': row} for row in value]
+
+
+def make_attachment(data, rows, attachment_format):
+    """Пишет полный результат сверки в сжатый gzip CSV или JSON."""
+    buffer = io.BytesIO()
+    with gzip.GzipFile(fileobj=buffer, mode='wb') as gzip_file:
+        with io.TextIOWrapper(gzip_file, encoding='utf-8', newline='') as text_file:
+            if attachment_format == 'json':
+                json.dump(data, text_file, ensure_ascii=False, separators=(',', ':'))
+            else:
+                fieldnames = list(dict.fromkeys(key for row in rows for key in row))
+                writer = csv.DictWriter(text_file, fieldnames=fieldnames)
+                writer.writeheader()
+                writer.writerows(rows)
+    buffer.seek(0)
+    return buffer, f'stock_equivalence.{attachment_format}.gz'
+
+
+def format_row(row):
+    return '; '.join(f'{key}: {value}' for key, value in row.items())
+
+
+class StockEquivalencePages:
+    """Хранит строки последних результатов сверки для листания без повторного запроса к 1С."""
+
+    def __init__(self, page_size, max_results=20):
+        self.page_size = page_size
+        self.max_results = max_results
+        self.results = OrderedDict()
+        self.tokens = itertools.count(1)
+        self.lock = threading.Lock()
+
+    def add(self, rows):
+        with self.lock:
+            token = str(next(self.tokens))
+            self.results[token] = rows
+            while len(self.results) > self.max_results:
+                self.results.popitem(last=False)
+        return token
+
+    def render(self, token, page):
+        """Возвращает текст страницы и клавиатуру листания, None - если результат уже удален."""
+        with self.lock:
+            rows = self.results.get(token)
+        if rows is None:
+            return None, None
+        pages_number = max((len(rows) + self.page_size - 1) // self.page_size, 1)
+        page = min(max(page, 0), pages_number - 1)
+        page_rows = rows[page * self.page_size:(page + 1) * self.page_size]
+        text = f'Страница {page + 1} из {pages_number}\n\n' + '\n'.join(map(format_row, page_rows))
+        buttons = []
+        if page > 0:
+            buttons.append(InlineKeyboardButton(text='◀', callback_data=f'se:{token}:{page - 1}'))
+        if page < pages_number - 1:
+            buttons.append(InlineKeyboardButton(text='▶', callback_data=f'se:{token}:{page + 1}'))
+        keyboard = InlineKeyboardMarkup([buttons]) if buttons else None
+        return text[:MESSAGE_LIMIT], keyboard
+
+
+stock_equivalence_pages = StockEquivalencePages(settings.STOCK_EQUIVALENCE_PAGE_SIZE)
+
+
 class StockEquivalence:
     url = settings.STOCK_DATA_EQUIVALENCE
     login = settings.LOGIN_1C
     password = settings.PASSWORD_1C
 
-    def __init__(self, update, update_1c_required):
+    def __init__(self, update, update_1c_required, force_refresh=False, diff_mode=False):
         self.callback_query = bool(update.callback_query)
         self.message = update.callback_query.message if self.callback_query else update.message
         self.update_1c_required = update_1c_required
+        self.force_refresh = force_refresh
+        self.diff_mode = diff_mode
+        self.cache_age = None
+        self.requested = False
         self.duration = '60' if update_1c_required else '5'
         initial_response = f'Делаем запрос...\nОжидание ~ {self.duration} сек.'
         if self.callback_query:
-            self.message.edit_text(initial_response)
+            self.status_message = self.message.edit_text(initial_response)
         else:
             self.message2 = self.message.reply_text(initial_response)
+            self.status_message = self.message2
 
+    @traced
     def make_request(self):
+        data, self.cache_age, self.requested = stock_equivalence_cache.get(
+            self.update_1c_required, self.request_1c, force_refresh=self.force_refresh,
+        )
+        return data
+
+    def request_1c(self):
         if self.update_1c_required:
             params = {'update': ''}
         else:
             params = {}
-        response = requests.get(self.url, params, auth=(self.login, self.password))
-        return json.dumps(response.json(), indent=2, ensure_ascii=False)
+        response = timed_request('stock_equivalence', requests.get, self.url, params, auth=(self.login, self.password))
+        response.raise_for_status()
+        return response.json()
 
     def start(self):
         start = perf_counter()
-        response = self.make_request()
+        data = self.make_request()
         finish = perf_counter()
 
-        time_taken_msg = (
-            f'Запрос занял {int(finish - start)} сек.\nСпасибо за ожидание 🙂'
-        )
-        if self.callback_query:
-            self.message.edit_text(time_taken_msg)
-            self.message.reply_text(response, quote=False)
+        if self.requested:
+            time_taken_msg = (
+                f'Запрос занял {int(finish - start)} сек.\nСпасибо за ожидание 🙂'
+            )
+        elif self.cache_age is None:
+            time_taken_msg = f'Ответ получен вместе с уже выполнявшимся запросом, ожидание {int(finish - start)} сек.'
         else:
-            self.message2.edit_text(time_taken_msg)
-            self.message2.reply_text(response, quote=False)
+            time_taken_msg = f'Ответ из кэша, возраст {int(self.cache_age)} сек.'
+        self.status_message.edit_text(time_taken_msg)
+        rows = discrepancy_rows(data)
+        if self.requested:
+            snapshot_store.add(rows, self.update_1c_required)
+        if self.diff_mode:
+            return self.send_diff()
+        return self.send_rows(data, rows, 'section', 'Строк в сверке', 'Расхождений нет')
+
+    def send_diff(self):
+        """Отправляет строки, изменившиеся между двумя последними снимками сверки того же режима."""
+        snapshots = snapshot_store.latest(self.update_1c_required, 2)
+        if len(snapshots) < 2:
+            text = 'Нет предыдущего снимка сверки для сравнения'
+            self.status_message.reply_text(text, quote=False)
+            return text
+        (current_at, current_rows), (previous_at, previous_rows) = snapshots
+        rows = diff_rows(previous_rows, current_rows, settings.STOCK_DIFF_KEY_FIELDS)
+        title = f'Изменений с {strftime("%d.%m %H:%M", localtime(previous_at))}'
+        return self.send_rows(rows, rows, 'change', title, 'Изменений с прошлой сверки нет')
+
+    @traced
+    def send_rows(self, data, rows, group_field, title, empty_text):
+        """
+        Отправляет краткую сводку, первую страницу строк и полный результат файлом.
+
+        Строки сохраняются в stock_equivalence_pages, чтобы листать их без запроса к 1С.
+        """
+        if not rows:
+            self.status_message.reply_text(empty_text, quote=False)
+            return empty_text
+        groups = Counter(row.get(group_field, 'Расхождения') for row in rows)
+        summary = f'{title}: {len(rows)}\n' + '\n'.join(
+            f'{group}: {rows_number}' for group, rows_number in groups.items()
+        )
+        token = stock_equivalence_pages.add(rows)
+        page_text, keyboard = stock_equivalence_pages.render(token, 0)
+        self.status_message.reply_text(f'{summary}\n\n{page_text}'[:MESSAGE_LIMIT], quote=False, reply_markup=keyboard)
+        attachment, file_name = make_attachment(data, rows, settings.STOCK_EQUIVALENCE_ATTACHMENT_FORMAT)
+        self.status_message.reply_document(attachment, file_name, quote=False)
+        return summary
@@ -0,0 +1,101 @@
+import json
+import time
+import zlib
+from collections import Counter
+from contextlib import closing
+
+from env_settings import settings
+from state_files import StateDatabase, state_path
+
+
+class SnapshotStore(StateDatabase):
+    """
+    История результатов сверки в SQLite.
+
+    Каждый результат хранится одной строкой со сжатым zlib JSON списка строк.
+    После записи старые снимки удаляются по количеству и возрасту.
+    """
+
+    schema = (
+        'CREATE TABLE IF NOT EXISTS snapshots ('
+        'id INTEGER PRIMARY KEY AUTOINCREMENT, '
+        'created_at REAL NOT NULL, '
+        'update_1c_required INTEGER NOT NULL, '
+        'rows_number INTEGER NOT NULL, '
+        'payload BLOB NOT NULL)'
+    )
+
+    def __init__(self, path, keep, max_age_days):
+        super().__init__(path)
+        self.keep = keep
+        self.max_age_days = max_age_days
+
+    def add(self, rows, update_1c_required):
+        payload = zlib.compress(json.dumps(rows, ensure_ascii=False, separators=(',', ':')).encode())
+        with self.lock, closing(self.connect()) as connection, connection:
+            connection.execute(
+                'INSERT INTO snapshots (created_at, update_1c_required, rows_number, payload) VALUES (?, ?, ?, ?)',
+                (time.time(), int(update_1c_required), len(rows), payload),
+            )
+            connection.execute(
+                'DELETE FROM snapshots WHERE id NOT IN (SELECT id FROM snapshots ORDER BY id DESC LIMIT ?) '
+                'OR created_at < ?',
+                (self.keep, time.time() - self.max_age_days * 24 * 60 * 60),
+            )
+
+    def latest(self, update_1c_required, number=2):
+        """Возвращает последние снимки режима сверки, начиная с самого нового: (время создания, строки)."""
+        with self.lock, closing(self.connect()) as connection:
+            snapshots = connection.execute(
+                'SELECT created_at, payload FROM snapshots WHERE update_1c_required = ? ORDER BY id DESC LIMIT ?',
+                (int(update_1c_required), number),
+            ).fetchall()
+        return [(created_at, json.loads(zlib.decompress(payload))) for created_at, payload in snapshots]
+
+
+def row_key(row, key_fields):
+    if key_fields:
+        return json.dumps([row.get(field) for field in key_fields], ensure_ascii=False)
+    values = [value for field, value in row.items() if field != 'section']
+    return json.dumps([row.get('section'), *values[:1]], ensure_ascii=False)
+
+
+def keyed_rows(rows, key_fields):
+    """Сопоставляет строкам ключи, повторяющимся ключам добавляется номер повтора."""
+    occurrences = Counter()
+    result = {}
+    for row in rows:
+        key = row_key(row, key_fields)
+        result[(key, occurrences[key])] = row
+        occurrences[key] += 1
+    return result
+
+
+def diff_rows(previous_rows, current_rows, key_fields=()):
+    """
+    Возвращает строки, которые появились, пропали или изменились.
+
+    Строки сопоставляются по полям key_fields, а без них - по разделу
+    и первому полю строки. У измененных строк поле diff перечисляет изменения.
+    """
+    previous = keyed_rows(previous_rows, key_fields)
+    current = keyed_rows(current_rows, key_fields)
+    result = []
+    for key, row in current.items():
+        previous_row = previous.get(key)
+        if previous_row is None:
+            result.append({'change': 'appeared', **row})
+        elif previous_row != row:
+            changes = ', '.join(
+                f'{field}: {previous_row.get(field)} → {row.get(field)}'
+                for field in dict.fromkeys([*previous_row, *row])
+                if previous_row.get(field) != row.get(field)
+            )
+            result.append({'change': 'changed', **row, 'diff': changes})
+    result.extend({'change': 'disappeared', **row} for key, row in previous.items() if key not in current)
+    return result
+
+
+snapshot_store = SnapshotStore(
+    state_path('stock_snapshots.sqlite3'), settings.STOCK_SNAPSHOTS_KEEP, settings.STOCK_SNAPSHOTS_MAX_AGE_DAYS,
+)
@@ -0,0 +1,138 @@
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+
+from env_settings import settings
+from state_files import state_path
+
+local = threading.local()
+log_lock = threading.Lock()
+
+
+class Span:
+    __slots__ = ('name', 'depth', 'start', 'duration')
+
+    def __init__(self, name, depth, start):
+        self.name = name
+        self.depth = depth
+        self.start = start
+        self.duration = None
+
+
+class Trace:
+    """Этапы одного запуска команды: имя, вложенность, начало от старта команды и длительность."""
+
+    def __init__(self, name, attributes):
+        self.name = name
+        self.attributes = attributes
+        self.started_at = time.time()
+        self.start = time.perf_counter()
+        self.duration = None
+        self.status = 'ok'
+        self.spans = []
+        self.depth = 0
+
+    def report(self):
+        """Возвращает таблицу этапов; повторяющиеся этапы одного уровня складываются."""
+        stages = {}
+        for span in self.spans:
+            if span.duration is None:
+                continue
+            key = (span.depth, span.name)
+            duration, count = stages.get(key, (0, 0))
+            stages[key] = (duration + span.duration, count + 1)
+        if not stages:
+            return ''
+        lines = ['Stages:']
+        for (depth, name), (duration, count) in stages.items():
+            repeats = f' x{count}' if count > 1 else ''
+            lines.append(f'{"  " * depth}{name}{repeats} {duration:.2f} s')
+        return '\n'.join(lines)
+
+    def to_json(self):
+        return {
+            'trace': self.name,
+            **self.attributes,
+            'started_at': time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(self.started_at)),
+            'duration': round(self.duration, 4),
+            'status': self.status,
+            'spans': [
+                {
+                    'name': span.name,
+                    'depth': span.depth,
+                    'start': round(span.start, 4),
+                    'duration': None if span.duration is None else round(span.duration, 4),
+                }
+                for span in self.spans
+            ],
+        }
+
+
+def current_trace():
+    return getattr(local, 'trace', None)
+
+
+@contextmanager
+def trace(name, **attributes):
+    """Собирает этапы, выполненные в этом потоке внутри блока, и дописывает их в журнал трасс."""
+    local.trace = current = Trace(name, attributes)
+    try:
+        yield current
+    except BaseException as e:
+        current.status = e.__class__.__name__
+        raise
+    finally:
+        local.trace = None
+        current.duration = time.perf_counter() - current.start
+        write_trace(current)
+
+
+@contextmanager
+def span(name):
+    """Замеряет этап текущей трассы, вне трассы ничего не делает."""
+    current = current_trace()
+    if current is None:
+        yield
+        return
+    started = time.perf_counter()
+    item = Span(name, current.depth, started - current.start)
+    current.spans.append(item)
+    current.depth += 1
+    try:
+        yield
+    finally:
+        current.depth -= 1
+        item.duration = time.perf_counter() - started
+
+
+def traced(func):
+    """Декоратор: выполняет функцию как этап с ее именем."""
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        with span(func.__name__):
+            return func(*args, **kwargs)
+    return wrapper
+
+
+def trace_report():
+    """Таблица этапов текущей трассы с переводом строки впереди, для добавления к ответу команды."""
+    current = current_trace()
+    report = current.report() if current else ''
+    return f'\n{report}' if report else ''
+
+
+def write_trace(current):
+    path = state_path('traces.jsonl')
+    line = json.dumps(current.to_json(), ensure_ascii=False) + '\n'
+    try:
+        with log_lock:
+            os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+            if os.path.exists(path) and os.path.getsize(path) > settings.TRACE_LOG_MAX_MB * 1024 * 1024:
+                os.replace(path, f'{path}.1')
+            with open(path, 'a', encoding='utf-8') as file:
+                file.write(line)
+    except OSError as e:
+        print(f'Trace of {current.name} was not written: {e}')